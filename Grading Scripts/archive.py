@@ -0,0 +1,81 @@
+from typing import Iterable, Optional
+from scoring import SUBMISSION_COLUMNS
+import pyarrow as pa
+import pyarrow.feather as feather
+import pandas as pd
+import tempfile
+import threading
+import os
+
+ARCHIVE_COMPRESSION:str = "zstd"
+SUBMISSION_SCHEMA = pa.schema([
+    ("handle", pa.string()),
+    ("id", pa.int64()),
+    ("contest_id", pa.int64()),
+    ("problem", pa.string()),
+    ("points", pa.float64()),
+    ("rating", pa.float64()),
+    ("verdict", pa.string()),
+    ("participant_type", pa.string()),
+    ("creation_time", pa.int64()),
+])
+
+class SubmissionArchive:
+    """On-disk archive of the submissions the scripts scored, as frames in the scoring.SUBMISSION_COLUMNS layout
+
+    Each kind of source (a collection name) has a directory of zstd compressed Arrow files, one
+    per key: a contest id, or a handle for practice. Rows are sorted by handle and id, and the
+    files are memory-mapped when read. Everything a score is computed from is kept, so scores
+    can be recomputed under new rules without calling Codeforces"""
+
+    def __init__(self, archive_dir:str) -> None:
+        self.archive_dir = archive_dir
+        self.lock = threading.Lock()
+
+    def get_path(self, kind:str, key:object) -> str:
+        """Returns the path of the file archiving a key"""
+        return os.path.join(self.archive_dir, kind, f"{str(key).lower()}.arrow")
+
+    def keys(self, kind:str) -> list[str]:
+        """Returns the keys archived for a kind"""
+        kind_dir:str = os.path.join(self.archive_dir, kind)
+        if not os.path.isdir(kind_dir):
+            return []
+        return sorted(name.removesuffix(".arrow") for name in os.listdir(kind_dir) if name.endswith(".arrow"))
+
+    def read(self, kind:str, key:object) -> Optional[pd.DataFrame]:
+        """Returns the archived submissions of a key, or None if it was never archived"""
+        path:str = self.get_path(kind, key)
+        if not os.path.exists(path):
+            return None
+        return feather.read_table(path, memory_map=True).to_pandas()
+
+    def write(self, kind:str, key:object, frame:pd.DataFrame) -> None:
+        """Atomically replaces the archived submissions of a key"""
+        path:str = self.get_path(kind, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        frame = frame[SUBMISSION_COLUMNS].sort_values(["handle", "id"], kind="stable")
+        table = pa.Table.from_pandas(frame, schema=SUBMISSION_SCHEMA, preserve_index=False)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        os.close(fd)
+        feather.write_feather(table, tmp_path, compression=ARCHIVE_COMPRESSION)
+        os.replace(tmp_path, path)
+
+    def put(self, kind:str, key:object, frame:pd.DataFrame, handles:Iterable[str]) -> None:
+        """Archives the submissions of a key, replacing the ones archived before for the given handles"""
+        handles = {handle.lower() for handle in handles if handle}
+        with self.lock:
+            saved:Optional[pd.DataFrame] = self.read(kind, key)
+            if saved is not None:
+                frame = pd.concat([saved[~saved["handle"].isin(handles)], frame], ignore_index=True)
+            self.write(kind, key, frame)
+
+    def append(self, kind:str, key:object, frame:pd.DataFrame) -> None:
+        """Adds submissions to the ones archived for a key, keeping one row per handle and submission"""
+        if frame.empty:
+            return
+        with self.lock:
+            saved:Optional[pd.DataFrame] = self.read(kind, key)
+            if saved is not None:
+                frame = pd.concat([saved, frame], ignore_index=True).drop_duplicates(subset=["handle", "id"], keep="last")
+            self.write(kind, key, frame)
@@ -0,0 +1,85 @@
+from classes import get_student_info, assign_contest_slots, ensure_indexes, write_metrics, metrics, Student, DB_NAME, STUDENT_COLLECTION, DIV2_COLLECTION, DIV3_COLLECTION, CF_CALLS_PER_SECOND
+from codeforces import set_cf_rate
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing as mp
+import update_div2
+import update_div3
+import pymongo
+import argparse
+import logging as log
+import sys
+
+logging = log.getLogger(__name__)
+
+DIVISIONS:dict[str, tuple[object, str]] = {
+    "div2": (update_div2, DIV2_COLLECTION),
+    "div3": (update_div3, DIV3_COLLECTION),
+}
+DEFAULT_WORKERS:int = 4
+
+worker_module = None
+
+def parse_args() -> argparse.Namespace:
+    """Parses the command line arguments"""
+    parser = argparse.ArgumentParser(description="Score many Div2/Div3 contests in parallel worker processes")
+    parser.add_argument("division", choices=list(DIVISIONS), help="division of the contests")
+    parser.add_argument("contest_ids", nargs="+", type=int, help="contest ids to score")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="worker processes, each scoring one contest at a time")
+    parser.add_argument("--mode", type=int, choices=[2, 3], default=3, help="2 to fetch per student, 3 for a single contest-wide fetch")
+    return parser.parse_args()
+
+def init_worker(division:str, workers:int) -> None:
+    """Connects a worker process and gives it its share of the Codeforces call limit"""
+    global worker_module
+    log.basicConfig(filename="batch_contests.log", filemode="a", level=log.DEBUG, force=True)
+    set_cf_rate(CF_CALLS_PER_SECOND / workers)
+    worker_module = DIVISIONS[division][0]
+    worker_module.connect()
+
+def score_contest(student_list:list[Student], mode:int, contest_id:int, contest_srl_no:int) -> int:
+    """Scores one contest in a worker process, returns the number of students scored"""
+    metrics.reset()
+    try:
+        return worker_module.run(student_list, mode, contest_id, contest_srl_no)
+    finally:
+        write_metrics(f"{worker_module.__name__.removeprefix('update_')}_{contest_id}")
+
+def main() -> int:
+    """Scores the contests and returns the number of contests that failed"""
+    args = parse_args()
+    module, collection_name = DIVISIONS[args.division]
+    client = pymongo.MongoClient()
+    db = client[DB_NAME]
+    ensure_indexes(db)
+    student_list:list[Student] = get_student_info(db[STUDENT_COLLECTION])
+    contest_ids:list[int] = sorted(set(args.contest_ids))
+    # Slots are reserved up front, so the columns do not depend on the order the workers finish in
+    slots:dict[int, int] = assign_contest_slots(db[collection_name], contest_ids)
+    client.close()
+    workers:int = max(1, min(args.workers, len(contest_ids)))
+    logging.info(msg=f"Scoring {len(contest_ids)} {args.division} contests with {workers} workers, slots {slots}")
+    failed:list[int] = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn"), initializer=init_worker, initargs=(args.division, workers)) as executor:
+        futures = {
+            executor.submit(score_contest, student_list, args.mode, contest_id, slots[contest_id]): contest_id
+            for contest_id in contest_ids
+        }
+        for future in as_completed(futures):
+            contest_id:int = futures[future]
+            try:
+                scored:int = future.result()
+            except Exception as e:
+                logging.exception(msg=f"Contest {contest_id} failed: {e}")
+                failed.append(contest_id)
+                continue
+            logging.info(msg=f"Contest {contest_id} scored for {scored} students in column slot {slots[contest_id]}")
+    if failed:
+        logging.error(msg=f"Failed contests: {sorted(failed)}")
+    return len(failed)
+
+if __name__ == "__main__":
+    log.basicConfig(filename="batch_contests.log", filemode="a", level=log.DEBUG, force=True)
+    logging.info(msg="Starting batch_contests.py")
+    failures:int = main()
+    logging.info(msg="Ending batch_contests.py")
+    sys.exit(1 if failures else 0)
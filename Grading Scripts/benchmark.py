@@ -0,0 +1,345 @@
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import urlsplit, parse_qs
+import multiprocessing as mp
+import argparse
+import queue
+import resource
+import tempfile
+import random
+import json
+import time
+import sys
+import os
+
+# The grading modules are imported inside the worker processes only, after the Codeforces url,
+# database name, rate limiter, cache and Google sheet have been pointed at the stand-ins
+
+FLOWS:list[str] = ["practice", "div2", "div2_per_handle", "div3", "labs", "endsem"]
+COHORTS:list[int] = [100, 1000, 10000]
+DIV2_CONTEST_ID:int = 1850
+DIV3_CONTEST_ID:int = 1851
+ENDSEM_CONTEST_IDS:list[str] = ["460001", "460002"]
+PROBLEMS:list[str] = ['A', 'B', 'C', 'D', 'E', 'F']
+START_TIME_STAMP:int = 1685298600 # Same as update_practice.START_TIME_STAMP
+ROLL_OFFSET:int = 2023000
+
+def get_handle(idx:int) -> str:
+    """Returns the synthetic handle of the idx-th student"""
+    return f"bench_user_{idx}"
+
+class SyntheticCodeforces:
+    """Generates deterministic Codeforces API payloads for a synthetic cohort"""
+
+    def __init__(self, cohort:int, submissions:int, practice_submissions:int, outsiders:float, invalid_ratio:float) -> None:
+        self.cohort = cohort
+        self.submissions = submissions
+        self.practice_submissions = practice_submissions
+        self.outsiders = outsiders
+        self.invalid = {get_handle(idx) for idx in range(0, cohort, int(1 / invalid_ratio))} if invalid_ratio > 0 else set()
+        self.contests:dict[str, list[dict]] = {}
+        self.by_handle:dict[str, dict[str, list[dict]]] = {}
+
+    def make_submission(self, rng:random.Random, sub_id:int, contest_id:int, handle:str, participant_type:str, created:int) -> dict:
+        """Returns a single submission with the fields the API sends"""
+        problem:str = rng.choice(PROBLEMS)
+        return {
+            "id": sub_id,
+            "contestId": contest_id,
+            "creationTimeSeconds": created,
+            "relativeTimeSeconds": 2147483647,
+            "problem": {
+                "contestId": contest_id,
+                "index": problem,
+                "name": f"Problem {problem}",
+                "type": "PROGRAMMING",
+                "points": 500.0 * (1 + PROBLEMS.index(problem)),
+                "rating": 800 + 100 * rng.randrange(20),
+                "tags": ["implementation"],
+            },
+            "author": {
+                "contestId": contest_id,
+                "members": [{"handle": handle}],
+                "participantType": participant_type,
+                "ghost": False,
+                "startTimeSeconds": created,
+            },
+            "programmingLanguage": "GNU C++17",
+            "verdict": "OK" if rng.random() < 0.5 else "WRONG_ANSWER",
+            "testset": "TESTS",
+            "passedTestCount": rng.randrange(50),
+            "timeConsumedMillis": rng.randrange(1000),
+            "memoryConsumedBytes": rng.randrange(1 << 26),
+        }
+
+    def contest_status(self, contest_id:str) -> list[dict]:
+        """Returns every submission of a contest, newest first"""
+        if contest_id not in self.contests:
+            rng = random.Random(contest_id)
+            authors:list[str] = [get_handle(idx) for idx in range(self.cohort)]
+            authors += [f"outsider_{idx}" for idx in range(int(self.cohort * self.outsiders))]
+            result:list[dict] = []
+            for author in authors:
+                for _ in range(self.submissions):
+                    participant_type:str = "CONTESTANT" if rng.random() < 0.8 else "PRACTICE"
+                    result.append(self.make_submission(rng, 0, int(contest_id), author, participant_type, START_TIME_STAMP + rng.randrange(1 << 20)))
+            result.sort(key=lambda submission: -submission["creationTimeSeconds"])
+            for idx, submission in enumerate(result):
+                submission["id"] = len(result) - idx
+            self.contests[contest_id] = result
+            self.by_handle[contest_id] = {}
+            for submission in result:
+                self.by_handle[contest_id].setdefault(submission["author"]["members"][0]["handle"], []).append(submission)
+        return self.contests[contest_id]
+
+    def user_status(self, handle:str) -> list[dict]:
+        """Returns the practice submissions of a handle, newest first"""
+        rng = random.Random(handle)
+        result:list[dict] = []
+        for idx in range(self.practice_submissions):
+            sub_id:int = (self.practice_submissions - idx) * self.cohort + int(handle.rsplit("_", 1)[1])
+            created:int = START_TIME_STAMP + (self.practice_submissions - idx) * 600
+            result.append(self.make_submission(rng, sub_id, 1000 + idx, handle, "PRACTICE", created))
+        return result
+
+    def answer(self, method:str, params:dict[str, str]) -> dict:
+        """Returns the API response for a call"""
+        handle:str = params.get("handle")
+        if handle is not None and (handle.lower() in self.invalid or not handle.startswith("bench_user_")):
+            return {"status": "FAILED", "comment": f"handle: User with handle {handle} not found"}
+        start:int = int(params.get("from", 1)) - 1
+        count:int = int(params.get("count", 1 << 30))
+        if method == "contest.status":
+            result:list[dict] = self.contest_status(params["contestId"])
+            if handle is not None:
+                result = self.by_handle[params["contestId"]].get(handle, [])
+            return {"status": "OK", "result": result[start:start + count]}
+        if method == "user.status":
+            return {"status": "OK", "result": self.user_status(handle)[start:start + count]}
+        if method == "contest.standings":
+            return {"status": "OK", "result": {"contest": {"id": int(params["contestId"]), "phase": "FINISHED"}, "problems": [], "rows": []}}
+        return {"status": "FAILED", "comment": f"Unknown method {method}"}
+
+def serve(port:int, payloads:SyntheticCodeforces, latency:float, requests_count, bytes_count, ready) -> None:
+    """Serves the synthetic Codeforces API on localhost until the process is terminated"""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self) -> None:
+            parts = urlsplit(self.path)
+            params:dict[str, str] = {key: vals[0] for key, vals in parse_qs(parts.query).items()}
+            body:bytes = json.dumps(payloads.answer(parts.path.rsplit("/", 1)[-1], params)).encode()
+            if latency:
+                time.sleep(latency)
+            with requests_count.get_lock():
+                requests_count.value += 1
+            with bytes_count.get_lock():
+                bytes_count.value += len(body)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args) -> None:
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    ready.set()
+    server.serve_forever()
+
+class FakeWorksheet:
+    """In-memory stand-in for a gspread worksheet that counts the API calls made on it"""
+
+    def __init__(self, calls:Counter) -> None:
+        self.cells:dict[tuple[int, int], object] = {}
+        self.calls = calls
+
+    def cell(self, row:int, col:int) -> SimpleNamespace:
+        self.calls["cell"] += 1
+        return SimpleNamespace(value=self.cells.get((row, col)))
+
+    def get_all_values(self, value_render_option=None) -> list[list]:
+        self.calls["get_all_values"] += 1
+        if not self.cells:
+            return []
+        grid:list[list] = [[""] * max(col for _, col in self.cells) for _ in range(max(row for row, _ in self.cells))]
+        for (row, col), value in self.cells.items():
+            grid[row - 1][col - 1] = value
+        return grid
+
+    def update_cell(self, row:int, col:int, value) -> None:
+        self.calls["update_cell"] += 1
+        self.calls["cells_written"] += 1
+        self.cells[(row, col)] = value
+
+    def batch_update(self, data:list[dict], raw:bool=True) -> None:
+        from gspread.utils import a1_to_rowcol
+        self.calls["batch_update"] += 1
+        for entry in data:
+            start_row, start_col = a1_to_rowcol(entry["range"].split(":")[0])
+            for row_idx, values in enumerate(entry["values"]):
+                for col_idx, value in enumerate(values):
+                    self.calls["cells_written"] += 1
+                    self.cells[(start_row + row_idx, start_col + col_idx)] = value if value is not None else ""
+
+class FakeSpreadsheet:
+    """In-memory stand-in for the course spreadsheet"""
+
+    def __init__(self) -> None:
+        self.calls:Counter = Counter()
+        self.worksheets:dict[int, FakeWorksheet] = {}
+
+    def get_worksheet(self, index:int) -> FakeWorksheet:
+        return self.worksheets.setdefault(index, FakeWorksheet(self.calls))
+
+def get_mongo_client(mongo_uri:str):
+    """Returns a client for the given mongod, or an in-memory mongomock client"""
+    if mongo_uri:
+        import pymongo
+        return pymongo.MongoClient(mongo_uri)
+    import mongomock
+    return mongomock.MongoClient()
+
+def run_flow(flow:str, cohort:int, args:argparse.Namespace, results) -> None:
+    """Runs one grading flow against the stand-ins in a fresh process and reports its measurements"""
+    workdir:str = tempfile.mkdtemp(prefix=f"bench_{flow}_{cohort}_")
+    os.chdir(workdir)
+    import logging as log
+    log.basicConfig(filename="benchmark.log", filemode="w", level=getattr(log, args.log_level), force=True)
+    import classes
+    from response_cache import ResponseCache
+    classes.CF_API_URL = f"http://127.0.0.1:{args.port}/api"
+    classes.DB_NAME = f"{classes.DB_NAME}-benchmark"
+    import codeforces
+    codeforces.cf_rate_limiter = codeforces.TokenBucket(args.cf_rate or 1e9, classes.CF_BURST)
+    codeforces.response_cache = ResponseCache(os.path.join(workdir, classes.CACHE_DIR), classes.CACHE_SIZE_CAP)
+    spreadsheet = FakeSpreadsheet()
+    classes.get_spreadsheet = lambda: spreadsheet
+    classes.get_worksheet = lambda sheet_name: spreadsheet.get_worksheet(classes.SHEET_NAME_TO_ID[sheet_name])
+    with open("CF_API_keys.json", "w") as f:
+        json.dump({"key": "benchmark", "secret": "benchmark"}, f)
+
+    client = get_mongo_client(args.mongo_uri)
+    client.drop_database(classes.DB_NAME)
+    student_docs:list[dict] = [
+        {"name": f"Student {idx}", "roll": ROLL_OFFSET + idx, "email": f"s{idx}@example.com", "sno": idx + 1, "cf_id": get_handle(idx)}
+        for idx in range(cohort)
+    ]
+    client[classes.DB_NAME][classes.STUDENT_COLLECTION].insert_many(student_docs)
+    student_list = classes.get_student_info(client[classes.DB_NAME][classes.STUDENT_COLLECTION])
+
+    result:dict = {"flow": flow, "students": cohort}
+    try:
+        if flow == "practice":
+            import update_practice as module
+            module.connect(client)
+            run = lambda: module.run(student_list)
+        elif flow in ("div2", "div2_per_handle"):
+            import update_div2 as module
+            module.connect(client)
+            run = lambda: module.run(student_list, 3 if flow == "div2" else 2, DIV2_CONTEST_ID)
+        elif flow == "div3":
+            import update_div3 as module
+            module.connect(client)
+            run = lambda: module.run(student_list, 3, DIV3_CONTEST_ID)
+        elif flow == "labs":
+            import update_labs as module
+            module.connect(client)
+            run = lambda: module.run(student_list)
+        else:
+            import pandas as pd
+            import update_endsem as module
+            pd.DataFrame({
+                "roll": [doc["roll"] for doc in student_docs],
+                "cf_id": [doc["cf_id"] for doc in student_docs],
+                "contest_id": [ENDSEM_CONTEST_IDS[idx % len(ENDSEM_CONTEST_IDS)] for idx in range(cohort)],
+            }).to_excel(module.ATTENDANCE_SHEET, index=False)
+            module.connect(client)
+            run = lambda: module.run(student_list)
+        for _ in range(args.runs):
+            spreadsheet.calls.clear()
+            start:float = time.perf_counter()
+            run()
+            result["wall_s"] = time.perf_counter() - start
+        classes.write_metrics(flow)
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["sheet_calls"] = sum(count for call, count in spreadsheet.calls.items() if call != "cells_written")
+    result["cells_written"] = spreadsheet.calls["cells_written"]
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    result["cf_calls_per_second"] = classes.CF_CALLS_PER_SECOND
+    client.drop_database(classes.DB_NAME)
+    results.put(result)
+
+def parse_args() -> argparse.Namespace:
+    """Parses the command line arguments"""
+    parser = argparse.ArgumentParser(description="Benchmark the update scripts against local Codeforces, Google Sheets and MongoDB stand-ins")
+    parser.add_argument("--flows", nargs="+", choices=FLOWS, default=FLOWS, help="flows to run, all of them by default")
+    parser.add_argument("--cohorts", nargs="+", type=int, default=COHORTS, help="numbers of students to run every flow with")
+    parser.add_argument("--submissions", type=int, default=10, help="submissions per student in every contest")
+    parser.add_argument("--practice-submissions", type=int, default=50, help="practice submissions per student")
+    parser.add_argument("--outsiders", type=float, default=1.0, help="participants from outside the cohort in a contest, per student")
+    parser.add_argument("--invalid-ratio", type=float, default=0.02, help="fraction of handles the stand-in reports as not found")
+    parser.add_argument("--runs", type=int, default=1, help="times to run every flow in a row, the timings and sheet calls of the last run are reported")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the stand-in waits before every response")
+    parser.add_argument("--cf-rate", type=float, default=0.0, help="Codeforces calls per second allowed, unlimited if 0")
+    parser.add_argument("--mongo-uri", default=None, help="mongod to use instead of mongomock, the benchmark database is dropped after every run")
+    parser.add_argument("--port", type=int, default=8931, help="port of the Codeforces stand-in")
+    parser.add_argument("--log-level", default="DEBUG", choices=["DEBUG", "INFO", "WARNING", "ERROR"], help="log level of the grading scripts")
+    parser.add_argument("--json", default=None, help="file to write the results to, for comparing runs")
+    return parser.parse_args()
+
+def print_results(results:list[dict]) -> None:
+    """Prints the results as a table"""
+    header:str = f"{'flow':<16}{'students':>9}{'wall s':>10}{'requests':>10}{'MB recv':>9}{'min API s':>11}{'sheet calls':>12}{'cells':>9}{'peak MB':>9}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        if "error" in result:
+            print(f"{result['flow']:<16}{result['students']:>9}  error: {result['error']}")
+            continue
+        print(
+            f"{result['flow']:<16}{result['students']:>9}{result['wall_s']:>10.2f}{result['requests']:>10}{result['bytes'] / (1 << 20):>9.1f}"
+            f"{result['requests'] / result['cf_calls_per_second']:>11.0f}{result['sheet_calls']:>12}{result['cells_written']:>9}{result['peak_rss_mb']:>9.0f}"
+        )
+    print("min API s: time the requests take at the real Codeforces call limit")
+
+def main() -> None:
+    """Runs every flow for every cohort size and reports the measurements"""
+    args = parse_args()
+    ctx = mp.get_context("spawn")
+    all_results:list[dict] = []
+    for cohort in args.cohorts:
+        payloads = SyntheticCodeforces(cohort, args.submissions, args.practice_submissions, args.outsiders, args.invalid_ratio)
+        requests_count, bytes_count, ready = ctx.Value("q", 0), ctx.Value("q", 0), ctx.Event()
+        server = ctx.Process(target=serve, args=(args.port, payloads, args.latency, requests_count, bytes_count, ready), daemon=True)
+        server.start()
+        ready.wait()
+        try:
+            for flow in args.flows:
+                requests_count.value = bytes_count.value = 0
+                results = ctx.Queue()
+                worker = ctx.Process(target=run_flow, args=(flow, cohort, args, results))
+                worker.start()
+                worker.join()
+                try:
+                    result:dict = results.get(timeout=5)
+                except queue.Empty:
+                    result:dict = {"flow": flow, "students": cohort, "error": f"worker exited with code {worker.exitcode}"}
+                result["requests"] = requests_count.value
+                result["bytes"] = bytes_count.value
+                all_results.append(result)
+                print(f"Finished {flow} with {cohort} students", file=sys.stderr)
+        finally:
+            server.terminate()
+            server.join()
+    print_results(all_results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(all_results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,20 @@
 from enum import Enum
-from typing import List, Optional
+from typing import Callable, Iterable, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from import_cache import ImportCache
+from archive import SubmissionArchive
+from metrics import Metrics, MongoMetricsListener
+from pymongo import monitoring, IndexModel, UpdateOne, ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+import uuid
+import logging as log
+import numpy as np
 import gspread
-import requests
-import json
 import time
 
+logging = log.getLogger(__name__)
+
 DB_NAME:str = "cp1-2023"
 STUDENT_COLLECTION:str = "students"
 PROBLEM_COLLECTION:str = "practice"
@@ -14,6 +24,15 @@ DIV2_CAP:int = 3000
 DIV3_COLLECTION:str = "div3"
 DIV3_CAP:int = 10
 LAB_COLLECTION:str = "labs"
+ENDSEM_COLLECTION:str = "endsem"
+GRADE_COLLECTION:str = "grades"
+CONTEST_SCORE_COLLECTION:str = "contest_scores" # One record per student per Div2/Div3 contest
+MONGO_BATCH_SIZE:int = 500 # Operations sent in a single bulk_write call
+CHECKPOINT_COLLECTION:str = "checkpoints"
+CHECKPOINT_BATCH_SIZE:int = 50 # Students whose results are saved together before their progress is checkpointed
+CHECKPOINT_MAX_AGE:int = 24 * 60 * 60 # Unfinished runs older than this are not resumed
+STAGING_SUFFIX:str = "_staging"
+PIPELINE_QUEUE_SIZE:int = 2 * CHECKPOINT_BATCH_SIZE # Items a pipeline stage can get ahead of the next one
 
 SHEET_ID:str = "1SHPTPYRx3ZDkgolJw7zGr6TLB41bb4jZDp23TZDq-lw"
 SHEET_NAME_TO_ID:dict[str, int] = {
@@ -24,6 +43,7 @@ SHEET_NAME_TO_ID:dict[str, int] = {
     "endsem": 4,
 }
 
+CF_API_URL:str = "https://codeforces.com/api"
 GROUP_ID:str = "uc4hHQ2lbv"
 LAB_IDS:dict[str, dict[str, str]] = {
     '1': { "main":"447928", "upsolve":"447930" },
@@ -37,31 +57,234 @@ UPSOLVE_RATIO:dict[int, float] = {
     '3': 0.4,
 }
 
-def get_json_resp(url:str)->dict:
-    """Returns the json response of the url"""
-    wait_time:int = 5
-    while wait_time <= 2560:
-        try:
-            res = requests.get(url)
-            if res.status_code != 200:
-                time.sleep(wait_time)
-                wait_time *= 2
-            else:      
-                data = res.json()
-                return data
-        except Exception as e:
-            time.sleep(wait_time)
-            wait_time *= 2
-    raise Exception(f"Error while fetching details for {url}")
+LAB_NUMS:list[str] = list(LAB_IDS)
+LAB_PROBLEMS:list[str] = ['A', 'B', 'C', 'D', 'E', 'F']
+LAB_INDEX:dict[str, int] = {lab_num: idx for idx, lab_num in enumerate(LAB_NUMS)}
+PROBLEM_INDEX:dict[str, int] = {problem: idx for idx, problem in enumerate(LAB_PROBLEMS)}
+LAB_MAX_SCORE:float = 15 # Score for solving every problem of a lab
+
+SHEET_FLUSH_ROWS:int = 50 # Rows buffered by a GoogleSheetConnector before it writes them out
+SHEET_BATCH_SIZE:int = 500 # Ranges sent in a single batch_update call
+SHEET_DIFF_SYNC:bool = True # Read each worksheet once per run and only write the cells that changed
+
+CF_CALLS_PER_SECOND:float = 0.5 # Codeforces allows one API call every 2 seconds
+CF_BURST:int = 1
+CF_MAX_WORKERS:int = 8
+
+CACHE_DIR:str = ".cf_cache"
+IMPORT_CACHE_DIR:str = ".import_cache" # Parsed spreadsheets, keyed by the content of the files
+ARCHIVE_DIR:str = "archive" # Scored submissions, for regrading without refetching
+CACHE_SIZE_CAP:int = 1 << 30 # 1 GiB
+CACHE_TTL:dict[str, int] = { # Seconds a response of each API method stays valid
+    "contest.status": 10 * 60,
+    "contest.standings": 10 * 60,
+    "user.status": 30 * 60,
+    "user.info": 24 * 60 * 60,
+}
+CF_RETRY_BASE_DELAY:float = 2
+CF_RETRY_MAX_DELAY:float = 60
+CF_RETRY_ATTEMPTS:int = 6
+CF_RUN_BUDGET:float = 30 * 60 # Seconds a run may spend backing off between retries before giving up
+CF_CALL_LIMIT_COMMENT:str = "Call limit exceeded"
+CF_CALL_LIMIT_DELAY:float = 10
+CF_RETRYABLE_COMMENTS:tuple[str, ...] = ("Internal Server Error", "temporarily unavailable")
+CF_BREAKER_THRESHOLD:int = 5 # Consecutive failed calls that open the circuit breaker
+CF_BREAKER_COOLDOWN:float = 120
+CF_USER_INFO_BATCH:int = 500 # Handles per user.info call, the API takes up to 10000 but the url has to stay short
+CF_HANDLE_PATTERN:str = r"^[A-Za-z0-9_.-]{3,24}$"
+METRICS_DIR:str = "metrics" # Prometheus textfiles are written here at the end of every run
+
+metrics = Metrics()
+monitoring.register(MongoMetricsListener(metrics))
+import_cache = ImportCache(IMPORT_CACHE_DIR)
+submission_archive = SubmissionArchive(ARCHIVE_DIR)
+
+def write_metrics(job:str) -> None:
+    """Logs a summary of the metrics of the run and writes them to the Prometheus textfile of the job"""
+    logging.info(msg=f"Metrics for {job}:\n{metrics.summary()}")
+    try:
+        path:str = metrics.write_textfile(METRICS_DIR, job)
+    except OSError as e:
+        logging.error(msg=f"Error while writing metrics for {job}: {e}")
+        return
+    logging.info(msg=f"Metrics for {job} written to {path}")
+
+def fetch_concurrently(func:Callable, items:list, max_workers:int=CF_MAX_WORKERS) -> list:
+    """Calls func on every item from a thread pool and returns the results in order"""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(func, items))
+
+class RunCheckpoint:
+    """Progress of a run of a job, saved in MongoDB so that a failed run can be resumed
+
+    The run stays open until finish is called. Starting the same job again while a run is
+    open resumes that run, and the students it marked done can be skipped. With fresh set,
+    the open runs of the job are closed instead and a new one is started"""
+
+    def __init__(self, db, job:str, max_age:int=CHECKPOINT_MAX_AGE, fresh:bool=False) -> None:
+        self.checkpoints = db[CHECKPOINT_COLLECTION]
+        self.job = job
+        doc = None
+        if fresh:
+            self.checkpoints.update_many({"job": job, "finished": None}, {"$set": {"finished": time.time()}, "$unset": {"done": ""}})
+        else:
+            doc = self.checkpoints.find_one({"job": job, "finished": None, "started": {"$gte": time.time() - max_age}})
+        self.resumed:bool = doc is not None
+        if doc is None:
+            doc = {"job": job, "run_id": uuid.uuid4().hex, "started": time.time(), "finished": None, "done": []}
+            self.checkpoints.insert_one(doc)
+        self.run_id:str = doc["run_id"]
+        self.done:set = set(doc["done"])
+        if self.resumed:
+            logging.info(msg=f"Resuming run {self.run_id} of {job}, {len(self.done)} students already done")
+
+    def mark_done(self, keys:list) -> None:
+        """Records that the students with the given keys are done"""
+        if not keys:
+            return
+        self.checkpoints.update_one({"run_id": self.run_id}, {"$addToSet": {"done": {"$each": keys}}})
+        self.done.update(keys)
+
+    def finish(self) -> None:
+        """Closes the run so that the next one starts from scratch"""
+        self.checkpoints.update_one(
+            {"run_id": self.run_id},
+            {"$set": {"finished": time.time(), "done_count": len(self.done)}, "$unset": {"done": ""}}
+        )
+
+def swap_collection(db, staging_name:str, target_name:str, key:str, expected:Iterable) -> None:
+    """Replaces the target collection with the staging collection in one atomic rename
+
+    Raises ValueError and leaves the target as it is unless the staging collection holds a
+    document for every expected value of key"""
+    if staging_name not in db.list_collection_names():
+        raise ValueError(f"{staging_name} does not exist, keeping {target_name}")
+    missing:set = set(expected) - set(db[staging_name].distinct(key))
+    if missing:
+        raise ValueError(f"{staging_name} is missing {len(missing)} documents, keeping {target_name}")
+    db[staging_name].rename(target_name, dropTarget=True)
+
+INDEXES:dict[str, list[IndexModel]] = {
+    STUDENT_COLLECTION: [IndexModel([("roll", ASCENDING)], unique=True), IndexModel([("cf_id", ASCENDING)])],
+    PROBLEM_COLLECTION: [IndexModel([("roll", ASCENDING)], unique=True)],
+    DIV2_COLLECTION: [IndexModel([("contest_id", ASCENDING)], unique=True), IndexModel([("srl_no", ASCENDING)], unique=True)],
+    DIV3_COLLECTION: [IndexModel([("contest_id", ASCENDING)], unique=True), IndexModel([("srl_no", ASCENDING)], unique=True)],
+    LAB_COLLECTION: [IndexModel([("student_roll", ASCENDING)], unique=True)],
+    ENDSEM_COLLECTION: [IndexModel([("roll", ASCENDING)], unique=True)],
+    GRADE_COLLECTION: [IndexModel([("roll", ASCENDING)], unique=True)],
+    CONTEST_SCORE_COLLECTION: [
+        IndexModel([("roll", ASCENDING), ("division", ASCENDING), ("contest_id", ASCENDING)], unique=True),
+        IndexModel([("division", ASCENDING), ("contest_id", ASCENDING), ("roll", ASCENDING)]),
+    ],
+    CHECKPOINT_COLLECTION: [IndexModel([("run_id", ASCENDING)], unique=True), IndexModel([("job", ASCENDING), ("finished", ASCENDING)])],
+}
+
+def create_indexes(collection, name:str) -> None:
+    """Creates the indexes of the named collection on collection, which may be a staging copy of it"""
+    try:
+        collection.create_indexes(INDEXES[name])
+    except Exception as e:
+        logging.error(msg=f"Error while creating indexes on {collection.name}: {e}")
+
+def ensure_indexes(db) -> None:
+    """Creates the indexes of every collection, doing nothing for the ones that already exist"""
+    for name in INDEXES:
+        create_indexes(db[name], name)
+
+def assign_contest_slots(collection, contest_ids:list[int]) -> dict[int, int]:
+    """Returns the sheet column slot of every contest
+
+    Contests scored before keep their slot. New ones get the next free slots in increasing
+    contest id order, reserved with upserts so that concurrent runs never share a slot"""
+    slots:dict[int, int] = {
+        doc["contest_id"]: doc["srl_no"]
+        for doc in collection.find({"contest_id": {"$in": list(contest_ids)}, "srl_no": {"$exists": True}})
+    }
+    last = collection.find_one({"srl_no": {"$exists": True}}, sort=[("srl_no", -1)])
+    next_slot:int = 1 + (last["srl_no"] if last else 0)
+    for contest_id in sorted(set(contest_ids) - set(slots)):
+        while True:
+            try:
+                doc = collection.find_one_and_update(
+                    {"contest_id": contest_id},
+                    {"$setOnInsert": {"contest_id": contest_id, "srl_no": next_slot}},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
+                break
+            except DuplicateKeyError:
+                # Another run took the slot (or inserted the contest) first
+                next_slot += 1
+        slots[contest_id] = doc["srl_no"]
+        next_slot = max(next_slot, doc["srl_no"]) + 1
+    return slots
+
+def save_contest_scores(db, division:str, contest:"Contest", replace:bool=False) -> None:
+    """Upserts the score record of every student scored in the contest, replace also drops the records of the students it leaves out"""
+    collection = db[CONTEST_SCORE_COLLECTION]
+    bulk_write_batched(collection, [
+        UpdateOne({"roll": record["roll"], "division": division, "contest_id": contest.contest_id}, {"$set": record}, upsert=True)
+        for record in contest.to_records(division)
+    ])
+    if replace:
+        collection.delete_many({"division": division, "contest_id": contest.contest_id, "roll": {"$nin": list(contest.scores)}})
+
+def clear_contest_scores(db, division:str, contest_id:int, rolls:list) -> None:
+    """Drops the score records of the given students for the contest"""
+    if rolls:
+        db[CONTEST_SCORE_COLLECTION].delete_many({"division": division, "contest_id": contest_id, "roll": {"$in": list(rolls)}})
+
+def migrate_contest_scores(db, division:str) -> None:
+    """Moves the scores stored as roll keyed fields of the contest documents of a division to the contest_scores collection"""
+    for doc in db[division].find({}):
+        scores:dict = {
+            int(key) if key.isdigit() else key: val
+            for key, val in doc.items() if key not in ("_id", "contest_id", "srl_no")
+        }
+        if not scores:
+            continue
+        save_contest_scores(db, division, Contest(contest_id=doc["contest_id"], srl_no=doc["srl_no"], scores=scores))
+        db[division].update_one({"_id": doc["_id"]}, {"$unset": {str(key): "" for key in scores}})
+        logging.info(msg=f"Moved {len(scores)} scores of {division} contest {doc['contest_id']} to {CONTEST_SCORE_COLLECTION}")
+
+def bulk_write_batched(collection, operations:list, batch_size:int=MONGO_BATCH_SIZE) -> None:
+    """Sends the write operations to the collection as unordered bulk writes of batch_size operations"""
+    for start in range(0, len(operations), batch_size):
+        collection.bulk_write(operations[start:start + batch_size], ordered=False)
+
+def get_student_info(students) -> list["Student"]:
+    """Returns the list of students stored in the students collection"""
+    student_list:list[Student] = []
+    cursor = students.find({})
+    for doc in cursor:
+        student_list.append(Student(
+            name=doc["name"],
+            roll=doc["roll"],
+            email=doc["email"],
+            srl_no=doc["sno"],
+            cf_id=doc["cf_id"],
+            cf_valid=doc.get("cf_valid", True)
+        ))
+    logging.info(msg=f"Student list created with {len(student_list)} students")
+    logging.debug(msg=f"Student list: {student_list}")
+    return student_list
 
 class Student:
 
-    def __init__(self, name:str, roll:str, email:str, srl_no:int, cf_id:str=None):
+    __slots__ = ("name", "roll", "email", "srl_no", "cf_id", "cf_valid")
+
+    def __init__(self, name:str, roll:str, email:str, srl_no:int, cf_id:str=None, cf_valid:bool=True):
         self.name = name
         self.roll = roll
         self.email = email
         self.srl_no = srl_no
         self.cf_id = cf_id
+        self.cf_valid = cf_valid
+
+    @property
+    def handle(self) -> Optional[str]:
+        """The handle to query Codeforces with, None if it is missing or was found invalid at import"""
+        return self.cf_id if self.cf_id and self.cf_valid else None
 
     def __str__(self):
         return f"{self.name} ({self.roll})"
@@ -75,11 +298,14 @@ class Student:
             "roll": self.roll,
             "email": self.email,
             "cf_id": self.cf_id,
+            "cf_valid": self.cf_valid,
             "sno" : self.srl_no,
         }
     
 class Contest:
 
+    __slots__ = ("contest_id", "srl_no", "scores")
+
     def __init__(self, contest_id:int, srl_no:int, scores:dict[int:int])->None:
         self.contest_id = contest_id
         self.srl_no = srl_no
@@ -95,40 +321,50 @@ class Contest:
         dict_val:dict = {}
         dict_val["contest_id"] = self.contest_id
         dict_val["srl_no"] = self.srl_no
-        for key, val in self.scores.items():
-            dict_val[str(key)] = val
         return dict_val
+
+    def to_records(self, division:str) -> list[dict]:
+        """Returns one contest_scores record per student scored"""
+        return [
+            {"roll": roll, "division": division, "contest_id": self.contest_id, "srl_no": self.srl_no, "score": score}
+            for roll, score in self.scores.items()
+        ]
     
 class Lab_performance:
+    """Scores of a student in every lab, stored as a (labs x problems) array"""
 
-    def __init__(self, student_roll:str)->None:
+    __slots__ = ("student_roll", "score_matrix", "tot_scores", "final_score")
+
+    def __init__(self, student_roll:str, score_matrix:np.ndarray=None, tot_scores:np.ndarray=None)->None:
         self.student_roll = student_roll
-        self.scores = {
-            '1': {'A':0, 'B':0, 'C':0, 'D':0, 'E':0, 'F':0},
-            '2': {'A':0, 'B':0, 'C':0, 'D':0, 'E':0, 'F':0},
-            '3': {'A':0, 'B':0, 'C':0, 'D':0, 'E':0, 'F':0},
-        }
-        self.tot_score = {
-            '1': 0,
-            '2': 0,
-            '3': 0,
-        }
+        self.score_matrix = np.zeros((len(LAB_NUMS), len(LAB_PROBLEMS))) if score_matrix is None else score_matrix
+        self.tot_scores = np.zeros(len(LAB_NUMS)) if tot_scores is None else tot_scores
         self.final_score = 0
 
+    @property
+    def scores(self)->dict[str, dict[str, float]]:
+        return {
+            lab_num: {problem: float(score) for problem, score in zip(LAB_PROBLEMS, lab_scores)}
+            for lab_num, lab_scores in zip(LAB_NUMS, self.score_matrix)
+        }
+
+    @property
+    def tot_score(self)->dict[str, float]:
+        return {lab_num: float(score) for lab_num, score in zip(LAB_NUMS, self.tot_scores)}
+
     def solved(self, lab_num:int, problem:str)->None:
-        self.scores[lab_num][problem] = 1
+        self.score_matrix[LAB_INDEX[lab_num], PROBLEM_INDEX[problem]] = 1
 
     def upsolved(self, lab_num:int, problem:str)->None:
-        if(self.scores[lab_num][problem] == 0):
-            self.scores[lab_num][problem] = UPSOLVE_RATIO[lab_num]
+        if(self.score_matrix[LAB_INDEX[lab_num], PROBLEM_INDEX[problem]] == 0):
+            self.score_matrix[LAB_INDEX[lab_num], PROBLEM_INDEX[problem]] = UPSOLVE_RATIO[lab_num]
 
     def get_score(self)->float:
-        for lab_num in ['1', '2', '3']:
-            self.tot_score[lab_num] = sum(self.scores[lab_num].values())*(15/6)
+        self.tot_scores[:] = self.score_matrix.sum(axis=1)*(LAB_MAX_SCORE/len(LAB_PROBLEMS))
         return self.tot_score
     
     def get_final_score(self)->float:
-        self.final_score = sum(self.tot_score.values()) - min(self.tot_score.values())
+        self.final_score = float(self.tot_scores.sum() - self.tot_scores.min())
         return self.final_score
     
     def __str__(self):
@@ -144,14 +380,118 @@ class Lab_performance:
         dict_val["tot_score"] = self.tot_score
         dict_val["final_score"] = self.final_score
         return dict_val
-    
+
+class Lab_matrix:
+    """Lab scores of a whole cohort, stored as one (students x labs x problems) array"""
+
+    __slots__ = ("rolls", "scores", "tot_scores", "final_scores")
+
+    def __init__(self, rolls:list[str])->None:
+        self.rolls = rolls
+        self.scores = np.zeros((len(rolls), len(LAB_NUMS), len(LAB_PROBLEMS)))
+        self.tot_scores = np.zeros((len(rolls), len(LAB_NUMS)))
+        self.final_scores = np.zeros(len(rolls))
+
+    def set_scores(self, students:np.ndarray, labs:np.ndarray, problems:np.ndarray, scores:np.ndarray)->None:
+        """Sets the scores of the given (student, lab, problem) index triples, keeping the best score of each"""
+        np.maximum.at(self.scores, (students, labs, problems), scores)
+
+    def get_score(self)->np.ndarray:
+        self.tot_scores = self.scores.sum(axis=2)*(LAB_MAX_SCORE/len(LAB_PROBLEMS))
+        return self.tot_scores
+
+    def get_final_score(self)->np.ndarray:
+        self.final_scores = self.tot_scores.sum(axis=1) - self.tot_scores.min(axis=1)
+        return self.final_scores
+
+    def get_counts(self)->tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns the number of problems solved, upsolved and unsolved by every student in every lab"""
+        solved = (self.scores == 1).sum(axis=2)
+        unsolved = (self.scores == 0).sum(axis=2)
+        return solved, len(LAB_PROBLEMS) - solved - unsolved, unsolved
+
+    def __len__(self)->int:
+        return len(self.rolls)
+
+    def __getitem__(self, idx:int)->Lab_performance:
+        lab_perf = Lab_performance(self.rolls[idx], self.scores[idx], self.tot_scores[idx])
+        lab_perf.final_score = float(self.final_scores[idx])
+        return lab_perf
+
+    def __str__(self):
+        return f"Labs for {len(self.rolls)} students"
+
+@lru_cache(maxsize=None)
+def get_spreadsheet() -> gspread.Spreadsheet:
+    """Returns the course spreadsheet, authenticating only once per process"""
+    google_account = gspread.service_account()
+    return google_account.open_by_key(SHEET_ID)
+
+@lru_cache(maxsize=None)
+def get_worksheet(sheet_name:str) -> gspread.Worksheet:
+    """Returns a worksheet of the course spreadsheet, fetching it only once per process"""
+    return get_spreadsheet().get_worksheet(SHEET_NAME_TO_ID[sheet_name])
+
+def same_cell_value(current, value) -> bool:
+    """Returns whether a cell read from the sheet already holds the value about to be written"""
+    if value is None or value == "":
+        return current in (None, "")
+    if isinstance(value, (int, float, np.number)) and isinstance(current, (int, float)):
+        return float(current) == float(value)
+    return str(current) == str(value)
+
 class GoogleSheetConnector:
-    """Class to connect to the Google sheet"""
+    """Class to connect to the Google sheet
+
+    In buffered mode, cell updates are collected in memory and written with batch_update
+    calls when flush is called or when flush_rows rows are pending.
 
-    def __init__(self, sheet_name:str) -> None:
-        google_account = gspread.service_account()
-        self.sheet = google_account.open_by_key(SHEET_ID)
-        self.worksheet = self.sheet.get_worksheet(SHEET_NAME_TO_ID[sheet_name])
+    In diff mode, which implies buffered mode, load_grid reads the whole worksheet in one
+    call and flush then only writes the cells whose values changed"""
+
+    def __init__(self, sheet_name:str, buffered:bool=False, flush_rows:int=0, diff:bool=False) -> None:
+        self.sheet = get_spreadsheet()
+        self.worksheet = get_worksheet(sheet_name)
+        self.buffered = buffered or diff
+        self.flush_rows = flush_rows
+        self.diff = diff
+        self.buffer:dict[int, dict[int, object]] = {}
+        self.grid:Optional[list[list]] = None
+
+    def load_grid(self) -> None:
+        """Reads the current values of the worksheet in diff mode, called at the start of every run"""
+        if not self.diff:
+            return
+        with metrics.timed("sheets_call", op="get_all_values"):
+            self.grid = self.worksheet.get_all_values(value_render_option=gspread.utils.ValueRenderOption.unformatted)
+
+    def get_grid_value(self, row:int, col:int):
+        """Returns the value of a cell in the grid read by load_grid"""
+        if row > len(self.grid) or col > len(self.grid[row - 1]):
+            return ""
+        return self.grid[row - 1][col - 1]
+
+    def set_grid_value(self, row:int, col:int, value) -> None:
+        """Records a value written to the sheet in the grid"""
+        while len(self.grid) < row:
+            self.grid.append([])
+        cells:list = self.grid[row - 1]
+        if len(cells) < col:
+            cells.extend([""] * (col - len(cells)))
+        cells[col - 1] = "" if value is None else value
+
+    def drop_unchanged(self) -> None:
+        """Removes the buffered cells that already hold their value in the sheet"""
+        changed:dict[int, dict[int, object]] = {}
+        unchanged:int = 0
+        for row, cells in self.buffer.items():
+            for col, value in cells.items():
+                if same_cell_value(self.get_grid_value(row, col), value):
+                    unchanged += 1
+                else:
+                    changed.setdefault(row, {})[col] = value
+        metrics.inc("sheets_cells_unchanged_total", unchanged)
+        self.buffer = changed
 
     def get_worksheet(self) -> gspread.Worksheet:
         """Returns the worksheet"""
@@ -163,8 +503,51 @@ class GoogleSheetConnector:
     
     def get_cell(self, row:int, col:int) -> str:
         """Returns the value of the cell"""
-        return self.worksheet.cell(row, col).value
+        if col in self.buffer.get(row, {}):
+            return self.buffer[row][col]
+        if self.grid is not None:
+            return self.get_grid_value(row, col)
+        with metrics.timed("sheets_call", op="cell"):
+            return self.worksheet.cell(row, col).value
     
     def update_cell(self, row:int, col:int, value) -> None:
         """Updates the value of the cell"""
-        self.worksheet.update_cell(row, col, value)
+        if not self.buffered:
+            with metrics.timed("sheets_call", op="update_cell"):
+                self.worksheet.update_cell(row, col, value)
+            metrics.inc("sheets_cells_written_total")
+            return
+        self.buffer.setdefault(row, {})[col] = value
+        if self.flush_rows and len(self.buffer) >= self.flush_rows:
+            self.flush()
+
+    def get_pending_ranges(self) -> list[dict]:
+        """Returns the buffered cells as a list of ranges of consecutive cells in a row"""
+        ranges:list[dict] = []
+        for row in sorted(self.buffer):
+            cols:list[int] = sorted(self.buffer[row])
+            start:int = 0
+            for idx in range(1, len(cols) + 1):
+                if idx < len(cols) and cols[idx] == cols[idx - 1] + 1:
+                    continue
+                ranges.append({
+                    "range": f"{gspread.utils.rowcol_to_a1(row, cols[start])}:{gspread.utils.rowcol_to_a1(row, cols[idx - 1])}",
+                    "values": [[self.buffer[row][col] for col in cols[start:idx]]],
+                })
+                start = idx
+        return ranges
+
+    def flush(self) -> None:
+        """Writes all the buffered cells to the sheet, skipping the unchanged ones in diff mode"""
+        if self.grid is not None:
+            self.drop_unchanged()
+        ranges:list[dict] = self.get_pending_ranges()
+        for start in range(0, len(ranges), SHEET_BATCH_SIZE):
+            with metrics.timed("sheets_call", op="batch_update"):
+                self.worksheet.batch_update(ranges[start:start + SHEET_BATCH_SIZE], raw=False)
+        metrics.inc("sheets_cells_written_total", sum(len(cols) for cols in self.buffer.values()))
+        if self.grid is not None:
+            for row, cells in self.buffer.items():
+                for col, value in cells.items():
+                    self.set_grid_value(row, col, value)
+        self.buffer = {}
@@ -0,0 +1,441 @@
+from classes import metrics, CACHE_DIR, CACHE_SIZE_CAP, CACHE_TTL, CF_API_URL, GROUP_ID, CF_CALLS_PER_SECOND, CF_BURST, CF_MAX_WORKERS, CF_RETRY_BASE_DELAY, CF_RETRY_MAX_DELAY, CF_RETRY_ATTEMPTS, CF_RUN_BUDGET, CF_CALL_LIMIT_COMMENT, CF_CALL_LIMIT_DELAY, CF_RETRYABLE_COMMENTS, CF_BREAKER_THRESHOLD, CF_BREAKER_COOLDOWN, CF_USER_INFO_BATCH, CF_HANDLE_PATTERN
+from response_cache import ResponseCache, CACHE_FOREVER
+from typing import Callable, Iterable, Iterator, Optional
+from urllib.parse import urlencode, urlsplit, parse_qs
+import logging as log
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+import hashlib
+import random
+import json
+import gzip
+import time
+import re
+import os
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+logging = log.getLogger(__name__)
+
+CF_KEYS_FILE:str = "CF_API_keys.json"
+FINISHED_CONTEST_IDS:set[str] = set() # Filled in as contest.standings reports contests FINISHED
+
+class TokenBucket:
+    """Thread safe token bucket, callers block in acquire until a token is available"""
+
+    def __init__(self, rate:float, capacity:int) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Takes a token, waiting for its turn if the bucket is empty"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait_time:float = -self.tokens / self.rate if self.tokens < 0 else 0
+        metrics.sleep(wait_time, reason="rate_limit")
+
+    def pause(self, seconds:float) -> None:
+        """Makes every caller wait at least seconds more before its next token"""
+        with self.lock:
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+cf_rate_limiter = TokenBucket(CF_CALLS_PER_SECOND, CF_BURST)
+response_cache = ResponseCache(CACHE_DIR, CACHE_SIZE_CAP)
+cf_session = requests.Session() # Shared so that connections to Codeforces are kept alive between calls
+cf_session.headers.update({"Accept-Encoding": "gzip, deflate"})
+cf_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=CF_MAX_WORKERS))
+cf_session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=CF_MAX_WORKERS))
+
+class CodeforcesError(Exception):
+    """Raised when the Codeforces API answers with a status other than OK"""
+
+    def __init__(self, comment:str) -> None:
+        super().__init__(comment)
+        self.comment = comment
+
+class CodeforcesUnavailable(Exception):
+    """Raised when a request is given up on: retries or the run backoff budget are exhausted, or the circuit breaker is open"""
+
+class RetryableError(Exception):
+    """Raised by a request attempt that failed in a way worth retrying"""
+
+    def __init__(self, reason:str, delay:float=0) -> None:
+        super().__init__(reason)
+        self.reason = reason
+        self.delay = delay
+
+def check_response(status_code:int, data:dict) -> None:
+    """Raises RetryableError if an answer of the API is a transient failure, fatal answers are left to the caller"""
+    if data.get("status") == "OK":
+        return
+    comment:str = data.get("comment") or ""
+    if CF_CALL_LIMIT_COMMENT in comment:
+        # Every thread backs off, not just the one that hit the limit
+        cf_rate_limiter.pause(CF_CALL_LIMIT_DELAY)
+        raise RetryableError("call_limit", CF_CALL_LIMIT_DELAY)
+    if status_code >= 500 or status_code == 429 or any(retryable in comment for retryable in CF_RETRYABLE_COMMENTS):
+        raise RetryableError(f"status_{status_code}")
+
+class CircuitBreaker:
+    """Opens after threshold consecutive failures, making calls fail fast for cooldown seconds
+
+    Once the cooldown is over calls go through again, the first success closes the breaker
+    and the first failure opens it for another cooldown"""
+
+    def __init__(self, threshold:int, cooldown:float) -> None:
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at:Optional[float] = None
+        self.lock = threading.Lock()
+
+    def check(self) -> None:
+        """Raises CodeforcesUnavailable while the breaker is open"""
+        with self.lock:
+            if self.opened_at is not None and time.monotonic() < self.opened_at + self.cooldown:
+                metrics.inc("cf_circuit_rejections_total")
+                raise CodeforcesUnavailable("circuit breaker is open")
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None or time.monotonic() >= self.opened_at + self.cooldown:
+                    logging.warning(msg=f"Circuit breaker opened after {self.failures} consecutive failures")
+                    metrics.inc("cf_circuit_opened_total")
+                self.opened_at = time.monotonic()
+
+class RetryPolicy:
+    """Retries transient failures with jittered exponential backoff
+
+    Gives up after max_attempts attempts, when the next wait would take the seconds the run
+    spent backing off past its budget, or while the circuit breaker is open. Time spent on
+    successful calls does not count against the budget, so a long healthy run is not cut short"""
+
+    def __init__(self, base_delay:float, max_delay:float, max_attempts:int, budget:float, breaker:CircuitBreaker) -> None:
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.budget = budget
+        self.breaker = breaker
+        self.lock = threading.Lock()
+        self.reset_budget()
+
+    def reset_budget(self) -> None:
+        """Starts a new run with a fresh backoff budget"""
+        with self.lock:
+            self.spent = 0.0
+
+    def reserve(self, delay:float) -> bool:
+        """Counts delay against the budget of the run, returns False if it would go past it"""
+        with self.lock:
+            if self.spent + delay > self.budget:
+                return False
+            self.spent += delay
+            return True
+
+    def get_delay(self, attempt:int) -> float:
+        """Returns the wait before retrying after the attempt-th failure, half fixed and half random"""
+        delay:float = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def call(self, func:Callable, method:str):
+        """Returns the result of func, retrying it while it raises RetryableError"""
+        for attempt in range(self.max_attempts):
+            self.breaker.check()
+            try:
+                result = func()
+            except RetryableError as e:
+                self.breaker.record_failure()
+                reason:str = e.reason
+                delay:float = max(e.delay, self.get_delay(attempt))
+            except CodeforcesError:
+                self.breaker.record_success()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+            if attempt + 1 == self.max_attempts:
+                break
+            if not self.reserve(delay):
+                metrics.inc("cf_budget_exhausted_total", method=method)
+                raise CodeforcesUnavailable(f"run backoff budget exhausted after {attempt + 1} attempts ({reason})")
+            metrics.inc("cf_retries_total", method=method, reason=reason)
+            metrics.sleep(delay, reason="retry_backoff")
+        raise CodeforcesUnavailable(f"gave up after {self.max_attempts} attempts ({reason})")
+
+cf_retry_policy = RetryPolicy(CF_RETRY_BASE_DELAY, CF_RETRY_MAX_DELAY, CF_RETRY_ATTEMPTS, CF_RUN_BUDGET, CircuitBreaker(CF_BREAKER_THRESHOLD, CF_BREAKER_COOLDOWN))
+
+def get_api_method(url:str) -> str:
+    """Returns the API method called by the url"""
+    return urlsplit(url).path.rsplit("/", 1)[-1]
+
+def cf_get(url:str, stream:bool=False) -> requests.Response:
+    """Sends a GET request to the Codeforces API once the shared rate limiter allows it"""
+    method:str = get_api_method(url)
+    cf_rate_limiter.acquire()
+    with metrics.timed("cf_request", method=method):
+        res = cf_session.get(url, stream=stream)
+        if not stream:
+            metrics.inc("cf_response_bytes_total", len(res.content), method=method)
+    metrics.inc("cf_requests_total", method=method, status=str(res.status_code))
+    return res
+
+def cache_ttl(url:str) -> int:
+    """Returns for how long the response of the url can be cached"""
+    parts = urlsplit(url)
+    method:str = get_api_method(url)
+    contest_id:list[str] = parse_qs(parts.query).get("contestId", [])
+    if method in ("contest.status", "contest.standings") and contest_id and contest_id[0] in FINISHED_CONTEST_IDS:
+        return CACHE_FOREVER
+    return CACHE_TTL.get(method, 0)
+
+def get_json_resp(url:str, ttl:Optional[int]=None)->dict:
+    """Returns the json response of the url from the cache or the API, retrying transient failures
+
+    Fatal answers such as an unknown handle are returned as they are, callers check their status"""
+    data = response_cache.get(url)
+    metrics.inc("cf_cache_total", method=get_api_method(url), result="miss" if data is None else "hit")
+    if data is not None:
+        return data
+    data = cf_retry_policy.call(lambda: request_json(url), get_api_method(url))
+    if data.get("status") == "OK":
+        response_cache.put(url, data, cache_ttl(url) if ttl is None else ttl)
+    return data
+
+def request_json(url:str) -> dict:
+    """Sends a single request and returns its json response, raising RetryableError if it is worth retrying"""
+    try:
+        res = cf_get(url)
+    except requests.RequestException as e:
+        raise RetryableError(type(e).__name__)
+    try:
+        data = res.json()
+    except ValueError:
+        raise RetryableError(f"status_{res.status_code}")
+    check_response(res.status_code, data)
+    return data
+
+def download_json(url:str) -> str:
+    """Streams the response of the url into a gzipped temporary file and returns its path, retrying transient failures"""
+    method:str = get_api_method(url)
+    def attempt() -> str:
+        try:
+            with cf_get(url, stream=True) as res:
+                if res.status_code != 200:
+                    try:
+                        data = res.json()
+                    except ValueError:
+                        raise RetryableError(f"status_{res.status_code}")
+                    check_response(res.status_code, data)
+                    raise CodeforcesError(data.get("comment"))
+                path:str = response_cache.get_temp_path()
+                try:
+                    with metrics.timed("cf_download", method=method), gzip.open(path, "wb") as f:
+                        for chunk in res.iter_content(chunk_size=1 << 16):
+                            f.write(chunk)
+                            metrics.inc("cf_response_bytes_total", len(chunk), method=method)
+                except BaseException:
+                    os.remove(path)
+                    raise
+                return path
+        except requests.RequestException as e:
+            raise RetryableError(type(e).__name__)
+    return cf_retry_policy.call(attempt, method)
+
+def read_status(path:str) -> tuple[str, Optional[str]]:
+    """Returns the status and comment of a gzipped response without reading its result"""
+    with gzip.open(path, "rb") as f:
+        if ijson is None:
+            data = json.load(f)
+            return data.get("status"), data.get("comment")
+        for prefix, event, value in ijson.parse(f):
+            if prefix == "status":
+                status:str = value
+                break
+        else:
+            return None, None
+    if status == "OK":
+        return status, None
+    with gzip.open(path, "rb") as f:
+        return status, next(ijson.items(f, "comment"), None)
+
+def iter_results(url:str, ttl:Optional[int]=None, predicate:Optional[Callable[[dict], bool]]=None) -> Iterator[dict]:
+    """Yields the items of the result of the url one at a time, keeping only those matching predicate
+
+    The response is streamed to disk and parsed incrementally with ijson when it is installed,
+    so memory use does not depend on the size of the response"""
+    path:Optional[str] = response_cache.get_path(url)
+    cached:bool = path is not None
+    metrics.inc("cf_cache_total", method=get_api_method(url), result="hit" if cached else "miss")
+    if not cached:
+        path = download_json(url)
+        status, comment = read_status(path)
+        if status != "OK":
+            os.remove(path)
+            raise CodeforcesError(comment)
+        ttl = cache_ttl(url) if ttl is None else ttl
+        if ttl != 0:
+            path = response_cache.put_file(url, path, ttl)
+            cached = True
+    try:
+        with gzip.open(path, "rb") as f:
+            items:Iterable[dict] = json.load(f)["result"] if ijson is None else ijson.items(f, "result.item", use_float=True)
+            for item in items:
+                if predicate is None or predicate(item):
+                    yield item
+    finally:
+        if not cached:
+            os.remove(path)
+
+def submission_filter(handles:Optional[set[str]]=None, verdict:Optional[str]=None, participant_type:Optional[str]=None, since:Optional[int]=None) -> Callable[[dict], bool]:
+    """Returns a predicate keeping the submissions by one of the handles (case insensitive) with the given verdict and participant type, made at or after since"""
+    handles = {handle.lower() for handle in handles} if handles is not None else None
+    def predicate(submission:dict) -> bool:
+        if verdict is not None and submission.get("verdict") != verdict:
+            return False
+        if participant_type is not None and submission["author"]["participantType"] != participant_type:
+            return False
+        if since is not None and submission["creationTimeSeconds"] < since:
+            return False
+        if handles is not None and not any(member["handle"].lower() in handles for member in submission["author"]["members"]):
+            return False
+        return True
+    return predicate
+
+def set_cf_rate(calls_per_second:float) -> None:
+    """Replaces the Codeforces rate limiter of this process, used to split the API limit between processes"""
+    global cf_rate_limiter
+    cf_rate_limiter = TokenBucket(calls_per_second, CF_BURST)
+
+class CodeforcesClient:
+    """Builds and signs Codeforces API calls and exposes the endpoints used by the scripts
+
+    Every call goes through get_json_resp or iter_results, so it shares their pooled
+    session, rate limiter, retry policy and cache"""
+
+    def __init__(self, api_url:str, group_id:str) -> None:
+        self.api_url = api_url
+        self.group_id = group_id
+        self.api_key:Optional[str] = None
+        self.api_secret:Optional[str] = None
+
+    def load_keys(self, path:str=CF_KEYS_FILE) -> None:
+        """Loads the api key and secret used to sign group calls"""
+        with open(path, "r") as f:
+            data = json.load(f)
+        self.api_key = data["key"]
+        self.api_secret = data["secret"]
+
+    def get_url(self, method:str, params:dict[str, object], signed:bool=False) -> str:
+        """Returns the url of a call, signed with the api key and secret if signed is set"""
+        params = {key: val for key, val in params.items() if val is not None}
+        if not signed:
+            return f"{self.api_url}/{method}?{urlencode(params)}"
+        if self.api_key is None:
+            raise ValueError("Codeforces api keys are not loaded")
+        query:str = urlencode(sorted({**params, "apiKey": self.api_key, "time": int(time.time())}.items()))
+        rand:str = str(random.randint(100000, 999999))
+        hash_str:str = hashlib.sha512(f"{rand}/{method}?{query}#{self.api_secret}".encode()).hexdigest()
+        return f"{self.api_url}/{method}?{query}&apiSig={rand}{hash_str}"
+
+    def get_contest_status_url(self, contest_id:int|str, handle:Optional[str]=None, group:bool=False, start:Optional[int]=1, count:Optional[int]=None) -> str:
+        """Returns the url of a contest.status call, group contests are signed"""
+        params:dict[str, object] = {"contestId": contest_id, "handle": handle, "from": start, "count": count}
+        if group:
+            params["groupCode"] = self.group_id
+        return self.get_url("contest.status", params, signed=group)
+
+    def contest_status(self, contest_id:int|str, handle:Optional[str]=None, group:bool=False, ttl:Optional[int]=None) -> dict:
+        """Returns the contest.status response for a contest, limited to a handle if it is given"""
+        return get_json_resp(self.get_contest_status_url(contest_id, handle, group), ttl)
+
+    def iter_contest_status(self, contest_id:int|str, group:bool=False, ttl:Optional[int]=None, predicate:Optional[Callable[[dict], bool]]=None, start:int=1, count:Optional[int]=None) -> Iterator[dict]:
+        """Yields the submissions of a contest matching predicate, newest first, streaming the response"""
+        return iter_results(self.get_contest_status_url(contest_id, group=group, start=start, count=count), ttl, predicate)
+
+    def iter_user_status(self, handle:str, start:int=1, count:Optional[int]=None, ttl:Optional[int]=None) -> Iterator[dict]:
+        """Yields the submissions of a handle, newest first"""
+        return iter_results(self.get_url("user.status", {"handle": handle, "from": start, "count": count}), ttl)
+
+    def get_contest_standings_url(self, contest_id:int|str, group:bool=False, start:int=1, count:int=1) -> str:
+        """Returns the url of a contest.standings call, group contests are signed"""
+        params:dict[str, object] = {"contestId": contest_id, "from": start, "count": count}
+        if group:
+            params["groupCode"] = self.group_id
+        return self.get_url("contest.standings", params, signed=group)
+
+    def contest_standings(self, contest_id:int|str, start:int=1, count:int=1, group:bool=False, ttl:Optional[int]=None) -> dict:
+        """Returns the contest.standings response for a contest"""
+        return get_json_resp(self.get_contest_standings_url(contest_id, group, start, count), ttl)
+
+    def user_info(self, handles:list[str], ttl:Optional[int]=None) -> dict:
+        """Returns the user.info response for the handles"""
+        return get_json_resp(self.get_url("user.info", {"handles": ";".join(handles)}), ttl)
+
+    def resolve_handles(self, handles:Iterable[str]) -> dict[str, Optional[str]]:
+        """Maps every lowercased handle to its canonical handle, or to None if no such user exists
+
+        Handles are checked CF_USER_INFO_BATCH at a time. user.info fails a whole batch on the
+        first unknown handle, naming it in the comment, so that handle is dropped and the batch
+        retried. Handles of a batch that failed for any other reason are left out of the result"""
+        resolved:dict[str, Optional[str]] = {}
+        pending:list[str] = []
+        unique:dict[str, str] = {}
+        for handle in handles:
+            if handle:
+                unique.setdefault(str(handle).strip().lower(), str(handle).strip())
+        for handle in unique.values():
+            if re.match(CF_HANDLE_PATTERN, handle):
+                pending.append(handle)
+            else:
+                resolved[handle.lower()] = None
+        for start in range(0, len(pending), CF_USER_INFO_BATCH):
+            batch:list[str] = pending[start:start + CF_USER_INFO_BATCH]
+            while batch:
+                data = self.user_info(batch)
+                if data.get("status") == "OK":
+                    for handle, user in zip(batch, data["result"]):
+                        resolved[handle.lower()] = user["handle"]
+                    break
+                missing = re.search(r"User with handle (\S+) not found", data.get("comment") or "")
+                if missing is None or missing.group(1).lower() not in {handle.lower() for handle in batch}:
+                    logging.error(msg=f"Error while resolving {len(batch)} handles: {data.get('comment')}")
+                    break
+                resolved[missing.group(1).lower()] = None
+                batch = [handle for handle in batch if handle.lower() != missing.group(1).lower()]
+        logging.info(msg=f"Resolved {len(resolved)} handles, {sum(handle is None for handle in resolved.values())} invalid")
+        return resolved
+
+    def contest_cache_ttl(self, contest_id:int|str, group:bool=False) -> Optional[int]:
+        """Returns CACHE_FOREVER if the contest is finished, so that its submissions never need to be refetched
+
+        The phase of a group contest is read with a signed call, unsigned ones are refused for it"""
+        if str(contest_id) in FINISHED_CONTEST_IDS:
+            return CACHE_FOREVER
+        try:
+            data = self.contest_standings(contest_id, group=group)
+        except Exception:
+            return None
+        if data.get("status") == "OK" and data["result"]["contest"]["phase"] == "FINISHED":
+            FINISHED_CONTEST_IDS.add(str(contest_id))
+            response_cache.put(self.get_contest_standings_url(contest_id, group), data, CACHE_FOREVER)
+            return CACHE_FOREVER
+        return None
+
+codeforces = CodeforcesClient(CF_API_URL, GROUP_ID)
@@ -0,0 +1,58 @@
+from classes import STUDENT_COLLECTION, PROBLEM_COLLECTION, PROBLEM_CAP, DIV2_COLLECTION, DIV2_CAP, DIV3_COLLECTION, DIV3_CAP, LAB_COLLECTION, ENDSEM_COLLECTION, GRADE_COLLECTION, CONTEST_SCORE_COLLECTION
+from typing import Optional
+import logging as log
+
+logging = log.getLogger(__name__)
+
+def division_scores(division:str) -> dict:
+    """Returns an expression keeping the contest_scores records of the student for one division"""
+    return {"$filter": {"input": "$contests", "cond": {"$eq": ["$$this.division", division]}}}
+
+def get_grade_pipeline(rolls:Optional[list]=None) -> list[dict]:
+    """Returns the aggregation on the students collection that recomputes the grades of the given rolls, or of everyone"""
+    pipeline:list[dict] = [{"$match": {"roll": {"$in": rolls}}}] if rolls is not None else []
+    pipeline += [
+        {"$project": {"_id": 0, "roll": 1, "name": 1, "cf_id": 1}},
+        {"$lookup": {"from": PROBLEM_COLLECTION, "localField": "roll", "foreignField": "roll", "as": "practice"}},
+        {"$lookup": {"from": CONTEST_SCORE_COLLECTION, "localField": "roll", "foreignField": "roll", "as": "contests"}},
+        {"$addFields": {DIV2_COLLECTION: division_scores(DIV2_COLLECTION), DIV3_COLLECTION: division_scores(DIV3_COLLECTION)}},
+        {"$lookup": {"from": LAB_COLLECTION, "localField": "roll", "foreignField": "student_roll", "as": "labs"}},
+        {"$lookup": {"from": ENDSEM_COLLECTION, "localField": "roll", "foreignField": "roll", "as": "endsem"}},
+        {"$project": {
+            "roll": 1,
+            "name": 1,
+            "cf_id": 1,
+            "practice": {"$min": [{"$ifNull": [{"$first": "$practice.score"}, 0]}, PROBLEM_CAP]},
+            "div2": {"$min": [{"$sum": f"${DIV2_COLLECTION}.score"}, DIV2_CAP]},
+            "div2_contests": {"$size": f"${DIV2_COLLECTION}"},
+            "div3": {"$min": [{"$sum": f"${DIV3_COLLECTION}.score"}, DIV3_CAP]},
+            "div3_contests": {"$size": f"${DIV3_COLLECTION}"},
+            "labs": {"$ifNull": [{"$first": "$labs.final_score"}, 0]},
+            "endsem": {"$ifNull": [{"$first": "$endsem.solved"}, 0]},
+            "updated": "$$NOW",
+        }},
+        {"$merge": {"into": GRADE_COLLECTION, "on": "roll", "whenMatched": "replace", "whenNotMatched": "insert"}},
+    ]
+    return pipeline
+
+def refresh_grades(db, rolls:Optional[list]=None) -> None:
+    """Recomputes the materialized grades of the given rolls, or of the whole cohort, on the server"""
+    try:
+        db[STUDENT_COLLECTION].aggregate(get_grade_pipeline(rolls))
+    except Exception as e:
+        logging.error(msg=f"Error while refreshing grades: {e}")
+        return
+    logging.info(msg=f"Refreshed grades for {'all students' if rolls is None else f'{len(rolls)} students'}")
+
+def get_grade(db, roll) -> Optional[dict]:
+    """Returns the materialized grade of a student"""
+    return db[GRADE_COLLECTION].find_one({"roll": roll}, {"_id": 0})
+
+def get_score_history(db, roll, division:Optional[str]=None) -> list[dict]:
+    """Returns the Div2/Div3 contest scores of a student, or only those of one division, ordered by division and contest id"""
+    query:dict = {"roll": roll} if division is None else {"roll": roll, "division": division}
+    return list(db[CONTEST_SCORE_COLLECTION].find(query, {"_id": 0}).sort([("division", 1), ("contest_id", 1)]))
+
+def get_grades(db) -> list[dict]:
+    """Returns the materialized grades of the whole cohort, ordered by roll"""
+    return list(db[GRADE_COLLECTION].find({}, {"_id": 0}).sort("roll", 1))
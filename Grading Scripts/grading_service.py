@@ -0,0 +1,85 @@
+from classes import get_student_info, write_metrics, metrics, Student, DB_NAME, STUDENT_COLLECTION
+from codeforces import cf_retry_policy
+import update_practice
+import update_div2
+import update_div3
+import update_labs
+import update_endsem
+import pymongo
+import argparse
+import logging as log
+import time
+
+logging = log.getLogger(__name__)
+
+JOBS:list[str] = ["practice", "div2", "div3", "labs", "endsem"]
+JOB_MODULES:dict[str, object] = {
+    "practice": update_practice,
+    "div2": update_div2,
+    "div3": update_div3,
+    "labs": update_labs,
+    "endsem": update_endsem,
+}
+CONTEST_MODE:int = 3 # Score Div2/Div3 contests with a single contest-wide fetch
+
+def parse_args() -> argparse.Namespace:
+    """Parses the command line arguments"""
+    parser = argparse.ArgumentParser(description="Run the grading jobs in one process, sharing the roster and all connections")
+    parser.add_argument("--jobs", nargs="+", choices=JOBS, default=JOBS, help="jobs to run, all of them by default")
+    parser.add_argument("--div2", nargs="*", type=int, default=[], help="Div2 contest ids to score")
+    parser.add_argument("--div3", nargs="*", type=int, default=[], help="Div3 contest ids to score")
+    parser.add_argument("--init", action="store_true", help="initialize the Div2/Div3 sheets before scoring contests")
+    parser.add_argument("--interval", type=int, default=0, help="seconds between two rounds of jobs, run once if 0")
+    return parser.parse_args()
+
+def run_job(job:str, student_list:list[Student], args:argparse.Namespace) -> None:
+    """Runs a single job, logging instead of raising its errors so that the other jobs still run"""
+    module = JOB_MODULES[job]
+    metrics.reset()
+    cf_retry_policy.reset_budget()
+    start:float = time.monotonic()
+    try:
+        if job in ("div2", "div3"):
+            contest_ids:list[int] = getattr(args, job)
+            if args.init:
+                module.run(student_list, 1)
+            if not contest_ids:
+                logging.warning(msg=f"No contest ids given for {job}, skipping")
+            for contest_id in contest_ids:
+                module.run(student_list, CONTEST_MODE, contest_id)
+        else:
+            module.run(student_list)
+    except Exception as e:
+        logging.exception(msg=f"Job {job} failed: {e}")
+        metrics.inc("job_failures_total")
+    else:
+        logging.info(msg=f"Job {job} finished in {time.monotonic() - start:.1f}s")
+    write_metrics(job)
+
+def main() -> None:
+    """Connect once and run the requested jobs once or every interval seconds"""
+    args = parse_args()
+    try:
+        client = pymongo.MongoClient()
+        for job in args.jobs:
+            JOB_MODULES[job].connect(client)
+    except Exception as e:
+        logging.error(msg=f"Error while connecting: {e}")
+        raise
+    while True:
+        round_start:float = time.monotonic()
+        # Reloaded every round so that students added or handles fixed by update_student_list are picked up
+        student_list:list[Student] = get_student_info(client[DB_NAME][STUDENT_COLLECTION])
+        for job in args.jobs:
+            logging.info(msg=f"Starting job {job}")
+            run_job(job, student_list, args)
+        if args.interval <= 0:
+            break
+        time.sleep(max(0, args.interval - (time.monotonic() - round_start)))
+    client.close()
+
+if __name__ == "__main__":
+    log.basicConfig(filename="grading_service.log", filemode="a", level=log.DEBUG, force=True)
+    logging.info(msg="Starting grading_service.py")
+    main()
+    logging.info(msg="Ending grading_service.py")
@@ -0,0 +1,51 @@
+from typing import Callable
+import pandas as pd
+import hashlib
+import tempfile
+import glob
+import os
+
+HASH_CHUNK_SIZE:int = 1 << 20
+
+class ImportCache:
+    """On-disk cache for frames parsed from local spreadsheets
+
+    Each frame is stored as a Parquet file named after the sha256 of the content of its
+    source files, so it is rebuilt only when one of them changes. Older versions of a
+    frame are removed when a new one is written"""
+
+    def __init__(self, cache_dir:str) -> None:
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def file_digest(path:str) -> str:
+        """Returns the sha256 of the content of a file"""
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def get_path(self, name:str, sources:list[str]) -> str:
+        """Returns the path of the Parquet file for the frame built from the current content of the sources"""
+        key:str = hashlib.sha256("".join(self.file_digest(source) for source in sources).encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{name}-{key[:32]}.parquet")
+
+    def get_frame(self, name:str, sources:list[str], build:Callable[[], pd.DataFrame]) -> pd.DataFrame:
+        """Returns the cached frame for the sources, calling build and caching its result if it is missing"""
+        path:str = self.get_path(name, sources)
+        if os.path.exists(path):
+            try:
+                return pd.read_parquet(path)
+            except Exception:
+                os.remove(path)
+        frame:pd.DataFrame = build()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        os.close(fd)
+        frame.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+        for old_path in glob.glob(os.path.join(self.cache_dir, f"{name}-*.parquet")):
+            if old_path != path:
+                os.remove(old_path)
+        return frame
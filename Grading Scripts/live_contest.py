@@ -0,0 +1,254 @@
+from classes import get_student_info, assign_contest_slots, save_contest_scores, clear_contest_scores, bulk_write_batched, write_metrics, Student, Contest, Lab_performance, STUDENT_COLLECTION, DIV2_COLLECTION, DIV3_COLLECTION, LAB_IDS, LAB_NUMS
+from grades import refresh_grades
+from codeforces import codeforces, cf_retry_policy, response_cache, CodeforcesError, CodeforcesUnavailable
+from scoring import submissions_frame, div2_scores, div3_scores
+from collections import defaultdict
+from typing import Callable, Optional
+from pymongo import UpdateOne
+import update_div2
+import update_div3
+import update_labs
+import pandas as pd
+import numpy as np
+import argparse
+import logging as log
+import time
+
+logging = log.getLogger(__name__)
+
+DIVISIONS:dict[str, tuple[object, str, Callable[[pd.DataFrame], pd.Series]]] = {
+    "div2": (update_div2, DIV2_COLLECTION, div2_scores),
+    "div3": (update_div3, DIV3_COLLECTION, div3_scores),
+}
+LAB_TARGET:str = "labs"
+POLL_INTERVAL:int = 60
+PAGE_SIZE:int = 1000 # Submissions requested per contest.status call
+PENDING_VERDICTS:tuple = (None, "TESTING")
+WAITING_PHASES:tuple = (None, "BEFORE") # Nothing is fetched until the contest starts
+LIVE_PHASE:str = "CODING" # Scored from the new submissions alone, the phases after it are rescored in full
+
+class LiveContest:
+    """Scores of the students in a running contest, kept up to date from the submissions made since the last poll
+
+    The watermark is the id up to which every submission has been seen with its final verdict,
+    submissions still being judged are fetched again by the next poll"""
+
+    def __init__(self, contest_id:int, student_list:list[Student], score_func:Callable[[pd.DataFrame], pd.Series], page_size:int=PAGE_SIZE, group:bool=False) -> None:
+        self.contest_id = contest_id
+        self.score_func = score_func
+        self.page_size = page_size
+        self.group = group
+        self.students:dict[str, Student] = {student.handle.lower(): student for student in student_list if student.handle}
+        self.submissions:dict[str, dict[int, dict]] = defaultdict(dict)
+        self.scores:dict[str, object] = {}
+        self.watermark:int = 0
+        self.pending:int = 0
+
+    def fetch_new_submissions(self) -> list[dict]:
+        """Returns the submissions of the contest newer than the watermark, walking the pages from the newest one"""
+        new_submissions:list[dict] = []
+        start:int = 1
+        while True:
+            page_size:int = 0
+            for submission in codeforces.iter_contest_status(self.contest_id, group=self.group, ttl=0, start=start, count=self.page_size):
+                page_size += 1
+                if submission["id"] <= self.watermark:
+                    return new_submissions
+                new_submissions.append(submission)
+            if page_size < self.page_size:
+                return new_submissions
+            start += self.page_size
+
+    def poll(self) -> list[Student]:
+        """Processes the submissions made since the last poll and returns the students whose score changed"""
+        new_submissions:list[dict] = self.fetch_new_submissions()
+        self.pending = 0
+        if not new_submissions:
+            return []
+        affected:set[str] = set()
+        for submission in new_submissions:
+            for member in submission["author"]["members"]:
+                handle:str = member["handle"].lower()
+                if handle in self.students:
+                    self.submissions[handle][submission["id"]] = submission
+                    affected.add(handle)
+        pending:list[int] = [submission["id"] for submission in new_submissions if submission.get("verdict") in PENDING_VERDICTS]
+        self.watermark = min(pending) - 1 if pending else max(submission["id"] for submission in new_submissions)
+        self.pending = len(pending)
+        logging.info(msg=f"{len(new_submissions)} new submissions in contest {self.contest_id}, {len(pending)} pending, {len(affected)} students affected")
+        if not affected:
+            return []
+        judged:list[dict] = [
+            submission for handle in affected for submission in self.submissions[handle].values()
+            if submission.get("verdict") not in PENDING_VERDICTS
+        ]
+        changed:list[Student] = []
+        for handle, score in self.score(affected, judged).items():
+            if score != self.scores.get(handle, 0):
+                self.scores[handle] = score
+                changed.append(self.students[handle])
+        return changed
+
+    def score(self, affected:set[str], judged:list[dict]) -> dict[str, object]:
+        """Returns the score of every affected handle from the judged submissions of those handles"""
+        scores:dict[str, int] = self.score_func(submissions_frame(judged, affected)).to_dict()
+        return {handle: int(scores.get(handle, 0)) for handle in affected}
+
+    def get_score(self, student:Student) -> int:
+        return self.scores.get(student.handle.lower(), 0)
+
+class LiveLab(LiveContest):
+    """Lab scores of the students, kept up to date from the new submissions to one lab contest
+
+    A lab score depends on every lab contest, so the submissions to the other ones are fetched
+    once at the start and the rows of the affected students are rescored along with them"""
+
+    def __init__(self, contest_id:int, student_list:list[Student], other_frame:pd.DataFrame, page_size:int=PAGE_SIZE) -> None:
+        super().__init__(contest_id, student_list, None, page_size, group=True)
+        self.other_frame = other_frame
+        self.performance:dict[str, tuple[Lab_performance, np.ndarray, np.ndarray]] = {}
+
+    def score(self, affected:set[str], judged:list[dict]) -> dict[str, object]:
+        """Returns the lab problem scores of every affected handle, keeping their lab performance for get_performance"""
+        students:list[Student] = [self.students[handle] for handle in affected]
+        frame:pd.DataFrame = pd.concat([
+            self.other_frame[self.other_frame["handle"].isin(affected)],
+            submissions_frame(judged, affected),
+        ], ignore_index=True)
+        lab_matrix = update_labs.lab_matrix_from_frame(students, frame)
+        cnt_solved, cnt_upsolved, _ = lab_matrix.get_counts()
+        scores:dict[str, object] = {}
+        for idx, student in enumerate(students):
+            handle:str = student.handle.lower()
+            self.performance[handle] = (lab_matrix[idx], cnt_solved[idx], cnt_upsolved[idx])
+            scores[handle] = tuple(lab_matrix.scores[idx].ravel())
+        return scores
+
+    def get_performance(self, student:Student) -> tuple[Lab_performance, np.ndarray, np.ndarray]:
+        """Returns the lab performance of a student and the problems solved and upsolved in every lab"""
+        return self.performance[student.handle.lower()]
+
+def parse_args() -> argparse.Namespace:
+    """Parses the command line arguments"""
+    parser = argparse.ArgumentParser(description="Keep the scores of a running Div2/Div3 contest or lab up to date")
+    parser.add_argument("target", choices=[*DIVISIONS, LAB_TARGET], help="division of the contest, or labs for a lab contest")
+    parser.add_argument("contest_id", type=int, help="contest id")
+    parser.add_argument("--interval", type=int, default=POLL_INTERVAL, help="seconds between two polls")
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE, help="submissions requested per call")
+    parser.add_argument("--until-finished", action="store_true", help="stop once the contest is finished and rescored")
+    return parser.parse_args()
+
+def get_phase(contest_id:int, group:bool=False) -> Optional[str]:
+    """Returns the current phase of the contest, or None if Codeforces did not report it"""
+    response_cache.invalidate(codeforces.get_contest_standings_url(contest_id, group))
+    data = codeforces.contest_standings(contest_id, group=group, ttl=0)
+    return data["result"]["contest"]["phase"] if data.get("status") == "OK" else None
+
+def rescore(contest_id:int, group:bool, run:Callable[[], object]) -> None:
+    """Rescores the whole contest with run, dropping the cached submissions first so that it sees the verdicts changed by system tests and hacks"""
+    response_cache.invalidate(codeforces.get_contest_status_url(contest_id, group=group))
+    run()
+    logging.info(msg=f"Rescored contest {contest_id}")
+
+def setup_division(args:argparse.Namespace, student_list:list[Student]) -> tuple[LiveContest, Callable[[list[Student]], None], Callable[[], object]]:
+    """Returns the tracker of a Div2/Div3 contest, the function writing the changed scores and the one rescoring the contest"""
+    module, collection_name, score_func = DIVISIONS[args.target]
+    db = module.db
+    contest_srl_no:int = assign_contest_slots(db[collection_name], [args.contest_id])[args.contest_id]
+    sheet_connector = module.sheet_connector
+    sheet_connector.update_cell(2, module.SHEET_COL_OFFSET + contest_srl_no, args.contest_id)
+    live:LiveContest = LiveContest(args.contest_id, student_list, score_func, args.page_size)
+    logging.info(msg=f"Tracking {args.target} contest {args.contest_id} in slot {contest_srl_no}")
+
+    def write(changed:list[Student]) -> None:
+        # Scores that dropped to 0 are cleared, like everywhere else
+        for student in changed:
+            sheet_connector.update_cell(module.SHEET_ROW_OFFSET + student.srl_no, module.SHEET_COL_OFFSET + contest_srl_no, live.get_score(student) or "")
+        save_contest_scores(db, collection_name, Contest(
+            contest_id=args.contest_id, srl_no=contest_srl_no,
+            scores={student.roll: live.get_score(student) for student in changed if live.get_score(student)}
+        ))
+        clear_contest_scores(db, collection_name, args.contest_id, [student.roll for student in changed if not live.get_score(student)])
+        sheet_connector.flush()
+        refresh_grades(db, [student.roll for student in changed])
+
+    return live, write, lambda: module.run(student_list, 3, args.contest_id, contest_srl_no, replace=True)
+
+def setup_lab(args:argparse.Namespace, student_list:list[Student]) -> tuple[LiveContest, Callable[[list[Student]], None], Callable[[], object]]:
+    """Returns the tracker of a lab contest, the function writing the changed rows and the one rescoring every lab"""
+    contest_ids:list[str] = [LAB_IDS[lab_num][kind] for lab_num in LAB_NUMS for kind in ("main", "upsolve")]
+    if str(args.contest_id) not in contest_ids:
+        raise ValueError(f"{args.contest_id} is not a lab contest")
+    handles:set[str] = {student.handle for student in student_list if student.handle}
+    other_frame:pd.DataFrame = pd.concat([
+        update_labs.group_contest_frame(contest_id, handles) for contest_id in contest_ids if contest_id != str(args.contest_id)
+    ], ignore_index=True)
+    live:LiveLab = LiveLab(args.contest_id, student_list, other_frame, args.page_size)
+    logging.info(msg=f"Tracking lab contest {args.contest_id}")
+
+    def write(changed:list[Student]) -> None:
+        operations:list[UpdateOne] = []
+        for student in changed:
+            lab_performance, cnt_solved, cnt_upsolved = live.get_performance(student)
+            update_labs.update_info(student, lab_performance, cnt_solved, cnt_upsolved)
+            operations.append(UpdateOne({"student_roll": student.roll}, {"$set": lab_performance.to_dict()}, upsert=True))
+        bulk_write_batched(update_labs.labs, operations)
+        update_labs.sheet_connector.flush()
+        refresh_grades(update_labs.db, [student.roll for student in changed])
+
+    return live, write, lambda: update_labs.run(student_list)
+
+def main() -> None:
+    """Poll the contest and write the changed scores to MongoDB and the sheet
+
+    Polling only sees submissions newer than the watermark, so once the contest leaves the
+    coding phase it is rescored in full on every phase change instead, and once more on exit"""
+    args = parse_args()
+    module = update_labs if args.target == LAB_TARGET else DIVISIONS[args.target][0]
+    module.connect()
+    student_list:list[Student] = get_student_info(module.db[STUDENT_COLLECTION])
+    module.sheet_connector.load_grid()
+    setup = setup_lab if args.target == LAB_TARGET else setup_division
+    live, write, run = setup(args, student_list)
+    job:str = f"live_{args.target}"
+    phase:Optional[str] = None
+    rescored_phase:Optional[str] = None
+    try:
+        while True:
+            poll_start:float = time.monotonic()
+            cf_retry_policy.reset_budget()
+            changed:list[Student] = []
+            try:
+                phase = get_phase(args.contest_id, live.group) or phase
+                if phase == LIVE_PHASE:
+                    changed = live.poll()
+                elif phase not in WAITING_PHASES and phase != rescored_phase:
+                    rescore(args.contest_id, live.group, run)
+                    rescored_phase = phase
+            except (CodeforcesUnavailable, CodeforcesError) as e:
+                logging.error(msg=f"Error while polling contest {args.contest_id}: {e}")
+            if changed:
+                write(changed)
+                logging.info(msg=f"Updated the scores of {len(changed)} students")
+            write_metrics(job)
+            if args.until_finished and rescored_phase == "FINISHED":
+                logging.info(msg=f"Contest {args.contest_id} is finished")
+                break
+            time.sleep(max(0, args.interval - (time.monotonic() - poll_start)))
+    except KeyboardInterrupt:
+        logging.info(msg=f"Stopped tracking contest {args.contest_id}")
+    if phase not in WAITING_PHASES and rescored_phase != "FINISHED":
+        # The last poll may have missed verdicts changed since, so the contest is rescored once more
+        cf_retry_policy.reset_budget()
+        try:
+            rescore(args.contest_id, live.group, run)
+        except (CodeforcesUnavailable, CodeforcesError) as e:
+            logging.error(msg=f"Error while rescoring contest {args.contest_id}: {e}")
+        write_metrics(job)
+    module.client.close()
+
+if __name__ == "__main__":
+    log.basicConfig(filename="live_contest.log", filemode="a", level=log.DEBUG, force=True)
+    logging.info(msg="Starting live_contest.py")
+    main()
+    logging.info(msg="Ending live_contest.py")
@@ -0,0 +1,158 @@
+from contextlib import contextmanager
+from typing import Iterator, Optional
+from pymongo import monitoring
+import threading
+import bisect
+import time
+import os
+
+LATENCY_BUCKETS:list[float] = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+METRIC_PREFIX:str = "grading_"
+
+Labels = tuple[tuple[str, str], ...]
+
+class Histogram:
+    """Cumulative histogram of observed values"""
+
+    __slots__ = ("buckets", "counts", "total", "count")
+
+    def __init__(self, buckets:list[float]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value:float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+class Metrics:
+    """Thread safe registry of counters and latency histograms
+
+    At the end of a run the values are written out in the Prometheus text format, so that a
+    node_exporter textfile collector can pick them up, and summarized in the log"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.counters:dict[str, dict[Labels, float]] = {}
+        self.histograms:dict[str, dict[Labels, Histogram]] = {}
+        self.started = time.time()
+
+    def inc(self, name:str, value:float=1, **labels:str) -> None:
+        """Adds value to a counter"""
+        key:Labels = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name:str, value:float, **labels:str) -> None:
+        """Records a value in a histogram"""
+        key:Labels = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(LATENCY_BUCKETS)
+            series[key].observe(value)
+
+    @contextmanager
+    def timed(self, name:str, **labels:str) -> Iterator[None]:
+        """Records the time spent in the block in the name_seconds histogram, counting errors in name_errors_total"""
+        start:float = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.inc(f"{name}_errors_total", error=type(e).__name__, **labels)
+            raise
+        finally:
+            self.observe(f"{name}_seconds", time.perf_counter() - start, **labels)
+
+    def sleep(self, seconds:float, reason:str) -> None:
+        """Sleeps, recording the time in sleep_seconds_total"""
+        if seconds <= 0:
+            return
+        self.inc("sleep_seconds_total", seconds, reason=reason)
+        time.sleep(seconds)
+
+    def reset(self) -> None:
+        """Clears every metric, for processes that do several runs"""
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.started = time.time()
+
+    @staticmethod
+    def escape_label_value(value:object) -> str:
+        """Escapes a label value as the Prometheus text format requires"""
+        return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    @staticmethod
+    def format_labels(labels:Labels, extra:Optional[dict[str, str]]=None) -> str:
+        """Returns the labels in the Prometheus {key="value"} form"""
+        items = list(labels) + list((extra or {}).items())
+        if not items:
+            return ""
+        return "{" + ",".join(f'{key}="{Metrics.escape_label_value(val)}"' for key, val in items) + "}"
+
+    def to_prometheus(self, job:str) -> str:
+        """Returns every metric in the Prometheus text format"""
+        lines:list[str] = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f"# TYPE {METRIC_PREFIX}{name} counter")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{METRIC_PREFIX}{name}{self.format_labels(labels, {'job': job})} {value}")
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {METRIC_PREFIX}{name} histogram")
+                for labels, histogram in sorted(series.items()):
+                    cumulative:int = 0
+                    for bound, count in zip(histogram.buckets + ["+Inf"], histogram.counts):
+                        cumulative += count
+                        lines.append(f"{METRIC_PREFIX}{name}_bucket{self.format_labels(labels, {'job': job, 'le': bound})} {cumulative}")
+                    lines.append(f"{METRIC_PREFIX}{name}_sum{self.format_labels(labels, {'job': job})} {histogram.total}")
+                    lines.append(f"{METRIC_PREFIX}{name}_count{self.format_labels(labels, {'job': job})} {histogram.count}")
+        lines.append(f"# TYPE {METRIC_PREFIX}run_seconds gauge")
+        lines.append(f"{METRIC_PREFIX}run_seconds{self.format_labels((), {'job': job})} {time.time() - self.started}")
+        lines.append(f"# TYPE {METRIC_PREFIX}last_run_timestamp_seconds gauge")
+        lines.append(f"{METRIC_PREFIX}last_run_timestamp_seconds{self.format_labels((), {'job': job})} {time.time()}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """Returns a readable summary of where the run spent its time"""
+        lines:list[str] = [f"Run took {time.time() - self.started:.1f}s"]
+        with self.lock:
+            for name, series in sorted(self.histograms.items()):
+                for labels, histogram in sorted(series.items()):
+                    lines.append(
+                        f"{name}{self.format_labels(labels)}: {histogram.count} calls, {histogram.total:.2f}s total, "
+                        f"{histogram.total / histogram.count:.3f}s mean"
+                    )
+            for name, series in sorted(self.counters.items()):
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{name}{self.format_labels(labels)}: {round(value, 3):,}")
+        return "\n".join(lines)
+
+    def write_textfile(self, metrics_dir:str, job:str) -> str:
+        """Atomically writes the metrics to metrics_dir/job.prom and returns its path"""
+        os.makedirs(metrics_dir, exist_ok=True)
+        path:str = os.path.join(metrics_dir, f"{job}.prom")
+        with open(f"{path}.tmp", "w") as f:
+            f.write(self.to_prometheus(job))
+        os.replace(f"{path}.tmp", path)
+        return path
+
+class MongoMetricsListener(monitoring.CommandListener):
+    """Records the count and latency of every command sent to MongoDB"""
+
+    def __init__(self, metrics:Metrics) -> None:
+        self.metrics = metrics
+
+    def started(self, event:monitoring.CommandStartedEvent) -> None:
+        pass
+
+    def succeeded(self, event:monitoring.CommandSucceededEvent) -> None:
+        self.metrics.observe("mongo_command_seconds", event.duration_micros / 1e6, command=event.command_name)
+
+    def failed(self, event:monitoring.CommandFailedEvent) -> None:
+        self.metrics.observe("mongo_command_seconds", event.duration_micros / 1e6, command=event.command_name)
+        self.metrics.inc("mongo_command_errors_total", command=event.command_name)
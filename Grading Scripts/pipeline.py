@@ -0,0 +1,108 @@
+from typing import Callable, Iterable, Iterator, Optional
+import threading
+import queue
+
+STAGE_DONE = object() # Sent down a queue by each thread of a stage once it has no more items
+
+class Pipeline:
+    """Runs items through fetch, score and write stages connected by bounded queues
+
+    fetch runs on fetch_workers threads and score on one thread, each going as fast as its
+    own rate limit lets it. The caller's thread is the write-behind stage, handing scored
+    items to write in batches of batch_size. The queues hold at most queue_size items, so a
+    slow stage holds the ones before it back, and a run takes about as long as its slowest
+    stage instead of the sum of them. The first error of any stage stops the others and is
+    raised in the caller"""
+
+    def __init__(self, fetch:Callable, score:Callable, write:Callable[[list[tuple]], None], fetch_workers:int, batch_size:int, queue_size:int) -> None:
+        self.fetch = fetch
+        self.score = score
+        self.write = write
+        self.fetch_workers = fetch_workers
+        self.batch_size = batch_size
+        self.fetched:queue.Queue = queue.Queue(maxsize=queue_size)
+        self.scored:queue.Queue = queue.Queue(maxsize=queue_size)
+        self.stop = threading.Event()
+        self.error:Optional[BaseException] = None
+
+    def put(self, out:queue.Queue, entry) -> bool:
+        """Puts entry on the queue once there is room, returns False if the pipeline stopped first"""
+        while not self.stop.is_set():
+            try:
+                out.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, src:queue.Queue):
+        """Returns the next entry of the queue, or STAGE_DONE if the pipeline stopped first"""
+        while not self.stop.is_set():
+            try:
+                return src.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return STAGE_DONE
+
+    def fail(self, e:BaseException) -> None:
+        """Stops every stage, keeping the first error"""
+        if self.error is None:
+            self.error = e
+        self.stop.set()
+
+    def fetch_stage(self, items:Iterator, lock:threading.Lock) -> None:
+        try:
+            while True:
+                with lock:
+                    item = next(items, STAGE_DONE)
+                if item is STAGE_DONE or not self.put(self.fetched, (item, self.fetch(item))):
+                    break
+        except BaseException as e:
+            self.fail(e)
+        self.put(self.fetched, STAGE_DONE)
+
+    def score_stage(self) -> None:
+        fetchers_left:int = self.fetch_workers
+        try:
+            while fetchers_left:
+                entry = self.get(self.fetched)
+                if entry is STAGE_DONE:
+                    fetchers_left -= 1
+                    continue
+                item, fetched = entry
+                if not self.put(self.scored, (item, self.score(item, fetched))):
+                    break
+        except BaseException as e:
+            self.fail(e)
+        self.put(self.scored, STAGE_DONE)
+
+    def run(self, items:Iterable) -> None:
+        """Runs every item through the stages, returning once the last batch is written"""
+        lock = threading.Lock()
+        items = iter(items)
+        threads:list[threading.Thread] = [
+            threading.Thread(target=self.fetch_stage, args=(items, lock), daemon=True)
+            for _ in range(self.fetch_workers)
+        ]
+        threads.append(threading.Thread(target=self.score_stage, daemon=True))
+        for thread in threads:
+            thread.start()
+        batch:list[tuple] = []
+        try:
+            while True:
+                entry = self.get(self.scored)
+                if entry is STAGE_DONE:
+                    break
+                batch.append(entry)
+                if len(batch) >= self.batch_size:
+                    self.write(batch)
+                    batch = []
+            if batch and self.error is None:
+                self.write(batch)
+        except BaseException as e:
+            self.fail(e)
+        self.stop.set()
+        for thread in threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,47 @@
+from classes import get_student_info, write_metrics, metrics, Student, DB_NAME, STUDENT_COLLECTION
+from grading_service import JOBS, JOB_MODULES
+import pymongo
+import argparse
+import logging as log
+import time
+
+logging = log.getLogger(__name__)
+
+def parse_args() -> argparse.Namespace:
+    """Parses the command line arguments"""
+    parser = argparse.ArgumentParser(description="Recompute the collections and sheets from the submission archive, without calling Codeforces")
+    parser.add_argument("--jobs", nargs="+", choices=JOBS, default=JOBS, help="jobs to regrade, all of them by default")
+    return parser.parse_args()
+
+def main() -> int:
+    """Regrades the requested jobs and returns the number of jobs that failed"""
+    args = parse_args()
+    try:
+        client = pymongo.MongoClient()
+        for job in args.jobs:
+            JOB_MODULES[job].connect(client)
+    except Exception as e:
+        logging.error(msg=f"Error while connecting: {e}")
+        raise
+    student_list:list[Student] = get_student_info(client[DB_NAME][STUDENT_COLLECTION])
+    failed:int = 0
+    for job in args.jobs:
+        metrics.reset()
+        start:float = time.monotonic()
+        try:
+            JOB_MODULES[job].regrade(student_list)
+        except Exception as e:
+            logging.exception(msg=f"Regrading {job} failed: {e}")
+            failed += 1
+        else:
+            logging.info(msg=f"Regraded {job} in {time.monotonic() - start:.1f}s")
+        write_metrics(f"regrade_{job}")
+    client.close()
+    return failed
+
+if __name__ == "__main__":
+    log.basicConfig(filename="regrade.log", filemode="a", level=log.DEBUG, force=True)
+    logging.info(msg="Starting regrade.py")
+    failures:int = main()
+    logging.info(msg="Ending regrade.py")
+    raise SystemExit(1 if failures else 0)
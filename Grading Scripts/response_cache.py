@@ -0,0 +1,128 @@
+from typing import Optional
+from urllib.parse import urlsplit, parse_qsl
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import gzip
+import json
+import time
+import os
+
+CACHE_FOREVER:int = -1
+VOLATILE_PARAMS:set[str] = {"time", "apiSig"} # Change on every signed request, so they are left out of the key
+
+class ResponseCache:
+    """Persistent on-disk cache for API responses
+
+    Bodies are stored gzipped in the cache directory and indexed in a sqlite database
+    with their expiry time and last access time. When the total size of the bodies goes
+    over size_cap, the least recently used entries are evicted"""
+
+    def __init__(self, cache_dir:str, size_cap:int) -> None:
+        self.cache_dir = cache_dir
+        self.size_cap = size_cap
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(cache_dir, "index.sqlite"), check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, size INTEGER, expires REAL, last_access REAL)"
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def get_key(url:str) -> str:
+        """Returns the cache key of a url, ignoring the order of the query parameters and the volatile ones"""
+        parts = urlsplit(url)
+        params = sorted((key, val) for key, val in parse_qsl(parts.query) if key not in VOLATILE_PARAMS)
+        return hashlib.sha256(f"{parts.path}?{params}".encode()).hexdigest()
+
+    def get_body_path(self, key:str) -> str:
+        """Returns the path of the file storing the body of an entry"""
+        return os.path.join(self.cache_dir, f"{key}.json.gz")
+
+    def get_path(self, url:str) -> Optional[str]:
+        """Returns the path of the gzipped body cached for the url, or None if it is missing or expired"""
+        key:str = self.get_key(url)
+        now:float = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT expires FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[0] is not None and row[0] < now:
+                self.remove(key)
+                return None
+            self.conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+        return self.get_body_path(key)
+
+    def get(self, url:str) -> Optional[dict]:
+        """Returns the cached response for the url, or None if it is missing or expired"""
+        path:Optional[str] = self.get_path(url)
+        if path is None:
+            return None
+        try:
+            with gzip.open(path, "rt") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            with self.lock:
+                self.remove(self.get_key(url))
+            return None
+
+    def get_temp_path(self) -> str:
+        """Returns the path of a new temporary file in the cache directory"""
+        fd, path = tempfile.mkstemp(suffix=".json.gz.tmp", dir=self.cache_dir)
+        os.close(fd)
+        return path
+
+    def put(self, url:str, data:dict, ttl:int) -> None:
+        """Stores the response for the url for ttl seconds, or forever if ttl is CACHE_FOREVER"""
+        if ttl == 0:
+            return
+        path:str = self.get_temp_path()
+        with gzip.open(path, "wt") as f:
+            json.dump(data, f)
+        self.put_file(url, path, ttl)
+
+    def put_file(self, url:str, path:str, ttl:int) -> str:
+        """Moves a gzipped response body into the cache and returns its new path"""
+        key:str = self.get_key(url)
+        body_path:str = self.get_body_path(key)
+        os.replace(path, body_path)
+        now:float = time.time()
+        expires:Optional[float] = None if ttl == CACHE_FOREVER else now + ttl
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO entries (key, size, expires, last_access) VALUES (?, ?, ?, ?)",
+                (key, os.path.getsize(body_path), expires, now)
+            )
+            self.evict(keep=key)
+            self.conn.commit()
+        return body_path
+
+    def invalidate(self, url:str) -> None:
+        """Removes the response cached for the url, if there is one"""
+        with self.lock:
+            self.remove(self.get_key(url))
+
+    def remove(self, key:str) -> None:
+        """Removes an entry, the caller must hold the lock"""
+        self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        self.conn.commit()
+        try:
+            os.remove(self.get_body_path(key))
+        except FileNotFoundError:
+            pass
+
+    def evict(self, keep:str) -> None:
+        """Evicts the least recently used entries other than keep until the cache fits in size_cap, the caller must hold the lock"""
+        total_size:int = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total_size <= self.size_cap:
+            return
+        for key, size in self.conn.execute("SELECT key, size FROM entries ORDER BY last_access").fetchall():
+            if total_size <= self.size_cap:
+                break
+            if key == keep:
+                continue
+            self.remove(key)
+            total_size -= size
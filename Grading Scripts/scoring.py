@@ -0,0 +1,73 @@
+from typing import Iterable, Optional
+import numpy as np
+import pandas as pd
+
+DIV2_WRONG_PENALTY:int = 50 # Points lost on a problem for every rejected submission
+
+SUBMISSION_COLUMNS:list[str] = [
+    "handle", "id", "contest_id", "problem", "points", "rating", "verdict", "participant_type", "creation_time"
+]
+
+def get_problem_score(prob_rating):
+    """Returns the score for a problem based on its rating, works on single ratings and arrays"""
+    return np.maximum(0, (prob_rating - 1099 + 199)//200)
+
+def submissions_frame(submissions:Iterable[dict], handles:Optional[set[str]]=None) -> pd.DataFrame:
+    """Returns a frame with one row per submission and author, keeping only the given handles (case insensitive)"""
+    if handles is not None:
+        handles = {handle.lower() for handle in handles}
+    rows:list[tuple] = []
+    for submission in submissions:
+        for member in submission["author"]["members"]:
+            handle:str = member["handle"].lower()
+            if handles is not None and handle not in handles:
+                continue
+            rows.append((
+                handle,
+                submission.get("id"),
+                submission.get("contestId"),
+                submission["problem"]["index"],
+                submission["problem"].get("points", np.nan),
+                submission["problem"].get("rating", np.nan),
+                submission.get("verdict"),
+                submission["author"]["participantType"],
+                submission.get("creationTimeSeconds"),
+            ))
+    return pd.DataFrame(rows, columns=SUBMISSION_COLUMNS)
+
+def div2_scores(frame:pd.DataFrame) -> pd.Series:
+    """Returns the Div2 score of every handle: per problem, the points of accepted submissions minus the penalty for rejected ones, floored at 0"""
+    contest = frame[frame["participant_type"] == "CONTESTANT"]
+    points = pd.Series(np.where(contest["verdict"] == "OK", contest["points"], -DIV2_WRONG_PENALTY), index=contest.index)
+    per_problem = points.groupby([contest["handle"], contest["problem"]]).sum().clip(lower=0)
+    return per_problem.groupby(level="handle").sum()
+
+def div3_scores(frame:pd.DataFrame) -> pd.Series:
+    """Returns the number of problems every handle solved as a contestant"""
+    solved = frame[(frame["participant_type"] == "CONTESTANT") & (frame["verdict"] == "OK")]
+    return solved.groupby("handle")["problem"].nunique()
+
+def solved_problems(frame:pd.DataFrame) -> dict[str, set[str]]:
+    """Returns the set of problems every handle solved as a contestant"""
+    solved = frame[(frame["participant_type"] == "CONTESTANT") & (frame["verdict"] == "OK")]
+    return {handle: set(problems) for handle, problems in solved.groupby("handle")["problem"]}
+
+def practice_counts(frame:pd.DataFrame) -> pd.DataFrame:
+    """Returns the number of accepted submissions of every handle in each problem score bucket"""
+    solved = frame[(frame["verdict"] == "OK") & frame["rating"].notna()]
+    buckets = get_problem_score(solved["rating"].astype(int))
+    return pd.crosstab(solved["handle"], buckets.rename("bucket"))
+
+def lab_problem_scores(frame:pd.DataFrame, lab_ids:dict[str, dict[str, str]], upsolve_ratio:dict[str, float]) -> pd.Series:
+    """Returns the score of every handle on every lab problem: 1 if solved during the lab, the lab's upsolve ratio if only upsolved"""
+    solved = frame[(frame["participant_type"] == "CONTESTANT") & (frame["verdict"] == "OK")]
+    contest_lab:dict[str, str] = {}
+    contest_weight:dict[str, float] = {}
+    for lab_num, contests in lab_ids.items():
+        contest_lab[contests["main"]] = contest_lab[contests["upsolve"]] = lab_num
+        contest_weight[contests["main"]] = 1.0
+        contest_weight[contests["upsolve"]] = upsolve_ratio[lab_num]
+    contest_ids = solved["contest_id"].astype(str)
+    weights = pd.Series(contest_ids.map(contest_weight).to_numpy(), index=solved.index)
+    labs = contest_ids.map(contest_lab).rename("lab")
+    return weights.groupby([solved["handle"], labs, solved["problem"]]).max()
@@ -1,10 +1,13 @@
-from classes import Student, Contest, GoogleSheetConnector, DB_NAME, STUDENT_COLLECTION, DIV3_COLLECTION, DIV3_CAP
+from classes import write_metrics, submission_archive, save_contest_scores, migrate_contest_scores, ensure_indexes, assign_contest_slots, CHECKPOINT_BATCH_SIZE, PIPELINE_QUEUE_SIZE, CF_MAX_WORKERS, get_student_info, Student, Contest, GoogleSheetConnector, SHEET_FLUSH_ROWS, SHEET_DIFF_SYNC, DB_NAME, STUDENT_COLLECTION, DIV3_COLLECTION, DIV3_CAP
+from grades import refresh_grades
+from typing import Callable, Optional
+from codeforces import codeforces, submission_filter, CodeforcesUnavailable
+from pipeline import Pipeline
+from scoring import submissions_frame, div3_scores
+import pandas as pd
 import pymongo
-import requests
 import logging as log
-import time
 
-log.basicConfig(filename="update_div3.log", filemode="w", level=log.DEBUG)
 logging = log.getLogger(__name__)
 
 client = None
@@ -16,49 +19,56 @@ sheet_connector = None
 SHEET_ROW_OFFSET:int = 2
 SHEET_COL_OFFSET:int = 3
 
-def get_student_info() -> list[Student]:
-    """Returns the list of students"""
-    student_list:list[Student] = []
-    cursor = students.find({})
-    for doc in cursor:
-        student_list.append(Student(
-            name=doc["name"],
-            roll=doc["roll"],
-            email=doc["email"],
-            srl_no=doc["sno"],
-            cf_id=doc["cf_id"]
-        ))
-    logging.info(msg=f"Student list created with {len(student_list)} students")
-    logging.debug(msg=f"Student list: {student_list}")
-    return student_list
-
-def compute_contest_score(cf_id:str, contest_id:int) -> int:
-    """Returns the score of a student for a contest"""
+def fetch_contest_submissions(cf_id:str, contest_id:int, ttl:Optional[int]=None) -> Optional[list[dict]]:
+    """Returns the submissions of a student in a contest, or None if they could not be fetched"""
+    if not cf_id:
+        return None
     try:
-        data = requests.get(f"https://codeforces.com/api/contest.status?contestId={contest_id}&handle={cf_id}&from=1").json()
+        data = codeforces.contest_status(contest_id, handle=cf_id, ttl=ttl)
         if data["status"] == "FAILED":
             logging.error(msg=f"Error while fetching details for {cf_id}")
-            return -1
+            return None
         if data["status"] != "OK":
             logging.error(msg=f"Error while fetching details for {cf_id}: {data['comment']}")
-            return -1
-        if data["result"] == []:
-            return 0
+            return None
     except Exception as e:
         logging.error(msg=f"Error while fetching details for {cf_id}: {e}")
-        return -1
+        return None
+    return data["result"]
+
+def score_submissions(submissions:list[dict]) -> int:
+    """Returns the number of problems solved in a contest from a student's submissions"""
     solved_problems:set[str] = set()
-    for submission in data["result"]:
+    for submission in submissions:
         if submission["verdict"] == "OK" and submission["author"]["participantType"] == "CONTESTANT":
             solved_problems.add(submission["problem"]["index"])
     return len(solved_problems)
 
-def main()->None:
-    """Update the score for all the students for the contest or intialize the sheet"""
+def compute_contest_scores(cf_ids:list[str], contest_id:int, ttl:Optional[int]=None) -> dict[str, int]:
+    """Returns the score of every handle for a contest using a single contest-wide fetch"""
+    handles:set[str] = {cf_id for cf_id in cf_ids if cf_id}
+    try:
+        submissions = codeforces.iter_contest_status(
+            contest_id, ttl=ttl,
+            predicate=submission_filter(handles=handles, participant_type="CONTESTANT")
+        )
+        frame = submissions_frame(submissions, handles)
+    except Exception as e:
+        logging.error(msg=f"Error while fetching details for contest {contest_id}: {e}")
+        return {}
+    logging.info(msg=f"Fetched {len(frame)} submissions by students for contest {contest_id}")
+    submission_archive.put(DIV3_COLLECTION, contest_id, frame, handles)
+    scores:dict[str, int] = div3_scores(frame).to_dict()
+    return {handle.lower(): scores.get(handle.lower(), 0) for handle in handles}
+
+def connect(mongo_client:pymongo.MongoClient=None)->None:
+    """Connect to MongoDB and the Google sheet, reusing mongo_client if it is given"""
     try:
         global client, db, students, div3_collection
-        client = pymongo.MongoClient()
+        client = mongo_client or pymongo.MongoClient()
         db = client[DB_NAME]
+        ensure_indexes(db)
+        migrate_contest_scores(db, DIV3_COLLECTION)
         students = db[STUDENT_COLLECTION]
         div3_collection = db[DIV3_COLLECTION]
     except Exception as e:
@@ -66,46 +76,124 @@ def main()->None:
         raise
     try:
         global sheet_connector
-        sheet_connector = GoogleSheetConnector("div3")
+        sheet_connector = GoogleSheetConnector("div3", buffered=True, flush_rows=SHEET_FLUSH_ROWS, diff=SHEET_DIFF_SYNC)
     except Exception as e:
         logging.error(msg=f"Error while connecting to Google Sheet: {e}")
         raise
-    student_list:list[Student] = get_student_info()
-    mode:int = int(input("Enter 1 to initialize, 2 to update the sheet: "))
+
+def write_scores(batch:list[tuple[Student, int]], contest_id:int, contest_srl_no:int, replace:bool=False) -> dict[int, int]:
+    """Writes the scores of a batch of students to the sheet and the contest_scores collection, returns the ones written
+
+    With replace the batch holds every student of the contest, and the scores of those left
+    without one are cleared"""
+    contest_scores:dict[int, int] = {}
+    for student, contest_score in batch:
+        if(contest_score == -1):
+            logging.error(msg=f"Error while fetching details for {student}")
+            continue
+        if contest_score == 0:
+            if replace:
+                sheet_connector.update_cell(SHEET_ROW_OFFSET + student.srl_no, SHEET_COL_OFFSET + contest_srl_no, "")
+            continue
+        sheet_connector.update_cell(SHEET_ROW_OFFSET + student.srl_no, SHEET_COL_OFFSET + contest_srl_no, contest_score)
+        contest_scores[student.roll] = contest_score
+    save_contest_scores(db, DIV3_COLLECTION, Contest(contest_id=contest_id, srl_no=contest_srl_no, scores=contest_scores), replace=replace)
+    sheet_connector.flush()
+    return contest_scores
+
+def run(student_list:list[Student], mode:int, contest_id:int=None, contest_srl_no:int=None, replace:bool=False)->int:
+    """Update the score for all the students for the contest or intialize the sheet, returns the number of students scored
+
+    The contest keeps its column if it was scored before, new contests get the next free one
+    unless contest_srl_no is given. With replace, mode 3 also clears the scores the contest-wide
+    fetch no longer gives, and raises CodeforcesUnavailable if that fetch fails"""
+    sheet_connector.load_grid()
+    contest_scores:dict[int, int] = {}
     if mode == 1:
         for student in student_list:
-            time.sleep(3)
             logging.info(msg=f"Updating div3 info for {student}")
             sheet_connector.update_cell(SHEET_ROW_OFFSET + student.srl_no, 1, student.name)
             sheet_connector.update_cell(SHEET_ROW_OFFSET + student.srl_no, 2, student.cf_id)
-    elif mode == 2:
-        contest_id:int = int(input("Enter the contest id: "))
+    elif mode in (2, 3):
         logging.info(msg=f"Fetching details for contest {contest_id}")
-        contest_srl_no:int = 1 + div3_collection.count_documents({})
+        if contest_srl_no is None:
+            contest_srl_no = assign_contest_slots(div3_collection, [contest_id])[contest_id]
         sheet_connector.update_cell(2, SHEET_COL_OFFSET + contest_srl_no, contest_id)
-        contest_scores:dict[int, int] = {}
-        for student in student_list:
-            time.sleep(2)
-            logging.info(msg=f"Fetching details info for {student}")
-            contest_score:int = compute_contest_score(student.cf_id, contest_id)
-            if(contest_score == -1):
-                logging.error(msg=f"Error while fetching details for {student}")
-                continue
-            if contest_score == 0:
-                continue
-            sheet_connector.update_cell(SHEET_ROW_OFFSET + student.srl_no, SHEET_COL_OFFSET + contest_srl_no, contest_score)
-            contest_scores[student.roll] = contest_score
-        contest = Contest(contest_id=contest_id, srl_no=contest_srl_no, scores=contest_scores)
+        ttl:Optional[int] = codeforces.contest_cache_ttl(contest_id)
+        write_batch:Callable[[list[tuple[Student, int]]], None] = lambda batch: contest_scores.update(write_scores(batch, contest_id, contest_srl_no))
+        if mode == 2:
+            logging.info(msg=f"Fetching details for {len(student_list)} students")
+            frames:list[pd.DataFrame] = []
+            handles:list[str] = []
+
+            def score_student(student:Student, submissions:Optional[list[dict]]) -> int:
+                if submissions is None:
+                    return -1
+                frames.append(submissions_frame(submissions, {student.handle}))
+                handles.append(student.handle)
+                return score_submissions(submissions)
+
+            Pipeline(
+                fetch=lambda student: fetch_contest_submissions(student.handle, contest_id, ttl),
+                score=score_student,
+                write=write_batch,
+                fetch_workers=CF_MAX_WORKERS,
+                batch_size=CHECKPOINT_BATCH_SIZE,
+                queue_size=PIPELINE_QUEUE_SIZE
+            ).run(student_list)
+            if frames:
+                submission_archive.put(DIV3_COLLECTION, contest_id, pd.concat(frames, ignore_index=True), handles)
+        else:
+            bulk_scores:dict[str, int] = compute_contest_scores([student.handle for student in student_list], contest_id, ttl)
+            if replace and not bulk_scores and any(student.handle for student in student_list):
+                raise CodeforcesUnavailable(f"could not fetch contest {contest_id}, keeping its scores")
+            contest_scores.update(write_scores([(student, bulk_scores.get(student.handle.lower(), -1) if student.handle else -1) for student in student_list], contest_id, contest_srl_no, replace))
         div3_collection.update_one(
             {"contest_id": contest_id},
-            {"$set": contest.to_dict()},
+            {"$set": Contest(contest_id=contest_id, srl_no=contest_srl_no, scores=contest_scores).to_dict()},
             upsert=True
         )
+        refresh_grades(db)
     else:
         logging.error(msg=f"Invalid mode {mode}")
         raise ValueError(f"Invalid mode {mode}")
+    sheet_connector.flush()
+    return len(contest_scores)
+
+def regrade(student_list:list[Student])->None:
+    """Recomputes the score of every student for every contest scored so far from the submission archive, without calling Codeforces"""
+    sheet_connector.load_grid()
+    for contest in div3_collection.find({}, {"_id": 0, "contest_id": 1, "srl_no": 1}).sort("srl_no", 1):
+        frame:Optional[pd.DataFrame] = submission_archive.read(DIV3_COLLECTION, contest["contest_id"])
+        if frame is None:
+            logging.warning(msg=f"Contest {contest['contest_id']} is not archived, keeping its scores")
+            continue
+        scores:dict[str, int] = div3_scores(frame).to_dict()
+        contest_scores:dict[int, int] = {}
+        for student in student_list:
+            if not student.handle:
+                continue
+            contest_score:int = int(scores.get(student.handle.lower(), 0))
+            # Scores that dropped to 0 under the new rules are cleared
+            sheet_connector.update_cell(SHEET_ROW_OFFSET + student.srl_no, SHEET_COL_OFFSET + contest["srl_no"], contest_score or "")
+            if contest_score:
+                contest_scores[student.roll] = contest_score
+        save_contest_scores(db, DIV3_COLLECTION, Contest(contest_id=contest["contest_id"], srl_no=contest["srl_no"], scores=contest_scores), replace=True)
+        sheet_connector.flush()
+        logging.info(msg=f"Regraded contest {contest['contest_id']} for {len(contest_scores)} students")
+    refresh_grades(db)
+
+def main()->None:
+    """Update the score for all the students for the contest or intialize the sheet"""
+    connect()
+    student_list:list[Student] = get_student_info(students)
+    mode:int = int(input("Enter 1 to initialize, 2 to update the sheet, 3 to update the sheet with a single contest-wide fetch: "))
+    contest_id:int = int(input("Enter the contest id: ")) if mode in (2, 3) else None
+    run(student_list, mode, contest_id)
+    write_metrics("div3")
 
 if __name__ == "__main__":
+    log.basicConfig(filename="update_div3.log", filemode="w", level=log.DEBUG)
     logging.info(msg="Starting update_div3.py")
     main()
     logging.info(msg="Ending update_div3.py")
\ No newline at end of file
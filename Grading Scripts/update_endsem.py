@@ -1,118 +1,144 @@
-from classes import get_json_resp, Student, Contest, GoogleSheetConnector, DB_NAME, STUDENT_COLLECTION, GROUP_ID
+from classes import write_metrics, submission_archive, import_cache, ensure_indexes, bulk_write_batched, fetch_concurrently, get_student_info, Student, GoogleSheetConnector, SHEET_FLUSH_ROWS, SHEET_DIFF_SYNC, DB_NAME, STUDENT_COLLECTION, ENDSEM_COLLECTION
+from grades import refresh_grades
+from codeforces import codeforces, submission_filter, CodeforcesError
+from scoring import submissions_frame, solved_problems
+from typing import Optional
 import pymongo
-import json
-import random
-import hashlib
+from pymongo import UpdateOne
+from collections import defaultdict
 import pandas as pd
-import requests
 import logging as log
-import time
 
 
-log.basicConfig(filename="update_endsem.log", filemode="w", level=log.DEBUG)
 logging = log.getLogger(__name__)
 
 client = None
 db = None
 students = None
+endsem_collection = None
 sheet_connector = None
 
 ATTENDANCE_SHEET:str = "Endsem_data.xlsx"
 
 SHEET_ROW_OFFSET:int = 2
 
-def load_codeforces_keys()->None:
-    """Load the codeforces keys from the json file"""
-    global CODEFORCES_KEY, CODEFORCES_SECRET
-    with open("CF_API_keys.json", "r") as f:
-        data = json.load(f)
-        CODEFORCES_KEY = data["key"]
-        CODEFORCES_SECRET = data["secret"]
-
-def questions_solved(contest_id:str, cf_id:str)->set[str]:
-    """Returns the set of questions solved by a student in a contest"""
-    cur_time = int(time.time())
-    random.seed(cur_time)
-    rand = str(random.randint(100000, 999999))
-    raw_str = f"{rand}/contest.status?apiKey={CODEFORCES_KEY}&contestId={contest_id}&groupCode={GROUP_ID}&handle={cf_id}&time={cur_time}#{CODEFORCES_SECRET}"
-    hash_str = hashlib.sha512(raw_str.encode()).hexdigest()
+def group_questions_solved(contest_id:str, cf_ids:set[str]) -> dict[str, set[str]]:
+    """Returns the set of questions solved in a contest by each of the handles, using a single fetch of the contest"""
     try:
-        data = get_json_resp(f"https://codeforces.com/api/contest.status?groupCode={GROUP_ID}&contestId={contest_id}&handle={cf_id}&apiKey={CODEFORCES_KEY}&time={cur_time}&apiSig={rand}{hash_str}")
-        if data["status"] == "FAILED":
-            logging.error(msg=f"Error while fetching details for {cf_id}")
-            return set()
-        if data["status"] != "OK":
-            logging.error(msg=f"Error while fetching details for {cf_id}: {data['comment']}")
-            return set()
-        if data["result"] == []:
-            logging.info(msg=f"No submissions for {cf_id} in contest {contest_id}")
-            return set()
+        submissions = codeforces.iter_contest_status(
+            contest_id, group=True, ttl=codeforces.contest_cache_ttl(contest_id, group=True),
+            predicate=submission_filter(handles=cf_ids, verdict="OK", participant_type="CONTESTANT")
+        )
+        frame:pd.DataFrame = submissions_frame(submissions, cf_ids)
+    except CodeforcesError as e:
+        logging.error(msg=f"Error while fetching details for contest {contest_id}: {e}")
+        return {}
     except Exception as e:
-        logging.error(msg=f"Error while fetching details for {cf_id}: {e}")
+        logging.error(msg=f"Error while fetching details for contest {contest_id}: {e}")
         raise e
-    solved_problems:set[str] = set()
-    for submission in data["result"]:
-        if submission["verdict"] == "OK" and submission["author"]["participantType"] == "CONTESTANT":
-            solved_problems.add(submission["problem"]["index"])
-    logging.debug(msg=f"Questions solved by {cf_id} in contest {contest_id}: {solved_problems}")
-    return solved_problems
+    submission_archive.put(ENDSEM_COLLECTION, contest_id, frame, cf_ids)
+    solved:dict[str, set[str]] = solved_problems(frame)
+    logging.debug(msg=f"Questions solved in contest {contest_id}: {solved}")
+    return solved
 
-def get_student_info() -> list[Student]:
-    """Returns the list of students"""
-    student_list:list[Student] = []
-    cursor = students.find({})
-    for doc in cursor:
-        student_list.append(Student(
-            name=doc["name"],
-            roll=doc["roll"],
-            email=doc["email"],
-            srl_no=doc["sno"],
-            cf_id=doc["cf_id"]
-        ))
-    logging.info(msg=f"Student list created with {len(student_list)} students")
-    logging.debug(msg=f"Student list: {student_list}")
-    return student_list
+def archived_questions_solved(contest_id:str) -> dict[str, set[str]]:
+    """Returns the set of questions solved in a contest by each of the handles archived for it"""
+    frame:Optional[pd.DataFrame] = submission_archive.read(ENDSEM_COLLECTION, contest_id)
+    if frame is None:
+        logging.warning(msg=f"Contest {contest_id} is not archived")
+        return {}
+    return solved_problems(frame)
+
+def read_attendance() -> pd.DataFrame:
+    """Reads the attendance sheet from the excel file, with one roll, cf_id and contest_id row per attendee"""
+    logging.info(msg=f"Parsing {ATTENDANCE_SHEET}")
+    sheet_data:pd.DataFrame = pd.read_excel(ATTENDANCE_SHEET).dropna().iloc[:, :3]
+    sheet_data.columns = ["roll", "cf_id", "contest_id"]
+    return pd.DataFrame({
+        "roll": sheet_data["roll"].astype("int64"),
+        "cf_id": sheet_data["cf_id"].astype(str),
+        "contest_id": sheet_data["contest_id"].astype("int64").astype(str),
+    })
 
 def get_attendance() -> dict[int:dict[str:str]]:
     """Returns the list of attendance records for endsem exam"""
     logging.info(msg="Fetching attendance records for endsem exam")
-    sheet_data = pd.read_excel(ATTENDANCE_SHEET)
-    sheet_data = sheet_data.dropna()
-    attendance:dict[int:dict[str:str]] = {}
-    for row in sheet_data.itertuples():
-        attendance[int(row[1])] = {"cf_id": row[2], "contest_id": str(int(row[3]))}
+    sheet_data:pd.DataFrame = import_cache.get_frame("attendance", [ATTENDANCE_SHEET], read_attendance)
+    attendance:dict[int:dict[str:str]] = {
+        record["roll"]: {"cf_id": record["cf_id"], "contest_id": record["contest_id"]}
+        for record in sheet_data.to_dict("records")
+    }
     logging.info(msg=f"Attendance records fetched for {len(attendance)} students")
     logging.debug(msg=f"Attendance records: {attendance}")
     return attendance
 
-def main()->None:
+def connect(mongo_client:pymongo.MongoClient=None)->None:
+    """Connect to MongoDB and the Google sheet, reusing mongo_client if it is given"""
     try:
-        global client, db, students, div3_collection
-        client = pymongo.MongoClient()
+        global client, db, students, endsem_collection
+        client = mongo_client or pymongo.MongoClient()
         db = client[DB_NAME]
+        ensure_indexes(db)
         students = db[STUDENT_COLLECTION]
-        load_codeforces_keys()
+        endsem_collection = db[ENDSEM_COLLECTION]
+        codeforces.load_keys()
     except Exception as e:
         logging.error(msg=f"Error while connecting to MongoDB: {e}")
         raise
     try:
         global sheet_connector
-        sheet_connector = GoogleSheetConnector("endsem")
+        sheet_connector = GoogleSheetConnector("endsem", buffered=True, flush_rows=SHEET_FLUSH_ROWS, diff=SHEET_DIFF_SYNC)
     except Exception as e:
         logging.error(msg=f"Error while connecting to Google Sheet: {e}")
         raise
-    student_list:list[Student] = get_student_info()
+
+def run(student_list:list[Student], from_archive:bool=False)->None:
+    """Update the endsem score for all the students who attended it"""
+    sheet_connector.load_grid()
     attendance_list:dict[int:dict[str:str]] = get_attendance()
+    attendees:list[Student] = []
     for student in student_list:
-        logging.info(msg=f"Updating details for {student.name} ({student.roll})")
         if student.roll not in attendance_list:
             logging.error(msg=f"No attendance record found for {student.name} ({student.roll})")
             continue
-        solve_cnt = len(questions_solved(attendance_list[student.roll]["contest_id"], attendance_list[student.roll]["cf_id"]))
+        attendees.append(student)
+    logging.info(msg=f"Fetching endsem details for {len(attendees)} students")
+    contest_handles:dict[str, set[str]] = defaultdict(set)
+    for student in attendees:
+        contest_handles[attendance_list[student.roll]["contest_id"]].add(str(attendance_list[student.roll]["cf_id"]))
+    contest_ids:list[str] = list(contest_handles)
+    if from_archive:
+        solved:dict[str, dict[str, set[str]]] = {contest_id: archived_questions_solved(contest_id) for contest_id in contest_ids}
+    else:
+        solved:dict[str, dict[str, set[str]]] = dict(zip(contest_ids, fetch_concurrently(lambda contest_id: group_questions_solved(contest_id, contest_handles[contest_id]), contest_ids)))
+    operations:list[UpdateOne] = []
+    for student in attendees:
+        logging.info(msg=f"Updating details for {student.name} ({student.roll})")
+        record:dict[str, str] = attendance_list[student.roll]
+        solve_cnt:int = len(solved[record["contest_id"]].get(str(record["cf_id"]).lower(), set()))
         sheet_connector.update_cell(SHEET_ROW_OFFSET + student.srl_no, 3, solve_cnt)
+        operations.append(UpdateOne(
+            {"roll": student.roll},
+            {"$set": {"roll": student.roll, "cf_id": str(record["cf_id"]), "contest_id": record["contest_id"], "solved": solve_cnt}},
+            upsert=True
+        ))
         logging.info(msg=f"Details updated for {student.name} ({student.roll})")
+    bulk_write_batched(endsem_collection, operations)
+    sheet_connector.flush()
+    refresh_grades(db)
+
+def regrade(student_list:list[Student])->None:
+    """Recomputes the endsem score of every attendee from the submission archive, without calling Codeforces"""
+    run(student_list, from_archive=True)
+
+def main()->None:
+    """Update the endsem score for all the students who attended it"""
+    connect()
+    run(get_student_info(students))
+    write_metrics("endsem")
 
 if __name__ == "__main__":
+    log.basicConfig(filename="update_endsem.log", filemode="w", level=log.DEBUG)
     logging.info(msg="Starting the update process")
     main()
     logging.info(msg="Update process completed")
\ No newline at end of file
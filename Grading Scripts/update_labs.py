@@ -1,13 +1,13 @@
-from classes import get_json_resp, Student, Lab_performance, GoogleSheetConnector, DB_NAME, STUDENT_COLLECTION, LAB_COLLECTION, LAB_IDS, GROUP_ID
+from classes import write_metrics, submission_archive, ensure_indexes, create_indexes, bulk_write_batched, swap_collection, RunCheckpoint, CHECKPOINT_BATCH_SIZE, STAGING_SUFFIX, fetch_concurrently, get_student_info, Student, Lab_performance, Lab_matrix, GoogleSheetConnector, SHEET_FLUSH_ROWS, SHEET_DIFF_SYNC, DB_NAME, STUDENT_COLLECTION, LAB_COLLECTION, LAB_IDS, LAB_NUMS, LAB_PROBLEMS, LAB_INDEX, PROBLEM_INDEX, UPSOLVE_RATIO
+from grades import refresh_grades
+from codeforces import codeforces, submission_filter, CodeforcesError
+from scoring import submissions_frame, lab_problem_scores
+import pandas as pd
+import numpy as np
 import pymongo
-import random
-import requests
+from pymongo import UpdateOne
 import logging as log
-import time
-import json
-import hashlib
 
-log.basicConfig(filename="update_labs.log", filemode="w", level=log.DEBUG)
 logging = log.getLogger(__name__)
 
 client = None
@@ -16,125 +16,149 @@ students = None
 labs = None
 
 SHEET_ROW_OFFSET:int = 2
-LAB_COL_OFFSETS:dict[str, int] = {
-    '1': 4,
-    '2': 7,
-    '3': 10,
-}
+LAB_COL_OFFSETS:dict[str, int] = {lab_num: 4 + 3*idx for idx, lab_num in enumerate(LAB_NUMS)}
 
-def load_codeforces_keys()->None:
-    """Load the codeforces keys from the json file"""
-    global CODEFORCES_KEY, CODEFORCES_SECRET
-    with open("CF_API_keys.json", "r") as f:
-        data = json.load(f)
-        CODEFORCES_KEY = data["key"]
-        CODEFORCES_SECRET = data["secret"]
-
-def get_student_info() -> list[Student]:
-    """Returns the list of students"""
-    student_list:list[Student] = []
-    cursor = students.find({})
-    for doc in cursor:
-        student_list.append(Student(
-            name=doc["name"],
-            roll=doc["roll"],
-            email=doc["email"],
-            srl_no=doc["sno"],
-            cf_id=doc["cf_id"]
-        ))
-    logging.info(msg=f"Student list created with {len(student_list)} students")
-    logging.debug(msg=f"Student list: {student_list}")
-    return student_list
-
-def questions_solved(contest_id:str, cf_id:str)->set[str]:
-    """Returns the set of questions solved by a student in a contest"""
-    cur_time = int(time.time())
-    random.seed(cur_time)
-    rand = str(random.randint(100000, 999999))
-    raw_str = f"{rand}/contest.status?apiKey={CODEFORCES_KEY}&contestId={contest_id}&groupCode={GROUP_ID}&handle={cf_id}&time={cur_time}#{CODEFORCES_SECRET}"
-    hash_str = hashlib.sha512(raw_str.encode()).hexdigest()
+def group_contest_frame(contest_id:str, cf_ids:set[str]) -> pd.DataFrame:
+    """Returns the accepted contestant submissions of the handles in a group contest as a frame"""
     try:
-        data = get_json_resp(f"https://codeforces.com/api/contest.status?groupCode={GROUP_ID}&contestId={contest_id}&handle={cf_id}&apiKey={CODEFORCES_KEY}&time={cur_time}&apiSig={rand}{hash_str}")
-        if data["status"] == "FAILED":
-            logging.error(msg=f"Error while fetching details for {cf_id}")
-            return set()
-        if data["status"] != "OK":
-            logging.error(msg=f"Error while fetching details for {cf_id}: {data['comment']}")
-            return set()
-        if data["result"] == []:
-            logging.info(msg=f"No submissions for {cf_id} in contest {contest_id}")
-            return set()
+        submissions = codeforces.iter_contest_status(
+            contest_id, group=True, ttl=codeforces.contest_cache_ttl(contest_id, group=True),
+            predicate=submission_filter(handles=cf_ids, verdict="OK", participant_type="CONTESTANT")
+        )
+        frame:pd.DataFrame = submissions_frame(submissions, cf_ids)
+    except CodeforcesError as e:
+        logging.error(msg=f"Error while fetching details for contest {contest_id}: {e}")
+        return submissions_frame([])
     except Exception as e:
-        logging.error(msg=f"Error while fetching details for {cf_id}: {e}")
+        logging.error(msg=f"Error while fetching details for contest {contest_id}: {e}")
         raise e
-    solved_problems:set[str] = set()
-    for submission in data["result"]:
-        if submission["verdict"] == "OK" and submission["author"]["participantType"] == "CONTESTANT":
-            solved_problems.add(submission["problem"]["index"])
-    logging.debug(msg=f"Questions solved by {cf_id} in contest {contest_id}: {solved_problems}")
-    return solved_problems
-    
-def get_Lab_performance(cf_id:str, roll:str) -> Lab_performance:
-    """Returns the performance of a student for all 3 lab"""
-    lab_perf:Lab_performance = Lab_performance(roll)
-    for lab_num in ['1', '2', '3']:
-        ques_solved = questions_solved(LAB_IDS[lab_num]["main"], cf_id)
-        for ques in ques_solved:
-            lab_perf.solved(lab_num, ques)
-        time.sleep(1)
-        ques_upsolved = questions_solved(LAB_IDS[lab_num]["upsolve"], cf_id)
-        for ques in ques_upsolved:
-            lab_perf.upsolved(lab_num, ques)
-        time.sleep(1)
-    lab_perf.get_score()
-    lab_perf.get_final_score()
-    logging.debug(msg=f"Lab performance for {cf_id}: {lab_perf.to_dict()}")
-    return lab_perf
+    logging.info(msg=f"Fetched {len(frame)} accepted submissions by students for contest {contest_id}")
+    submission_archive.put(LAB_COLLECTION, contest_id, frame, cf_ids)
+    return frame
 
-def main()->None:
-    """Update the lab score for all the students for the contest or intialize the sheet"""
+def archived_contest_frame(contest_id:str) -> pd.DataFrame:
+    """Returns the accepted contestant submissions archived for a group contest as a frame"""
+    frame = submission_archive.read(LAB_COLLECTION, contest_id)
+    if frame is None:
+        logging.warning(msg=f"Contest {contest_id} is not archived")
+        return submissions_frame([])
+    return frame
+
+def get_Lab_matrix(student_list:list[Student], from_archive:bool=False) -> Lab_matrix:
+    """Returns the performance of every student for all the labs, fetching each lab contest once or reading it from the archive"""
+    cf_ids:set[str] = {student.handle for student in student_list if student.handle}
+    contest_ids:list[str] = [LAB_IDS[lab_num][kind] for lab_num in LAB_NUMS for kind in ("main", "upsolve")]
+    if from_archive:
+        frames:list[pd.DataFrame] = [archived_contest_frame(contest_id) for contest_id in contest_ids]
+    else:
+        frames:list[pd.DataFrame] = fetch_concurrently(lambda contest_id: group_contest_frame(contest_id, cf_ids), contest_ids)
+    return lab_matrix_from_frame(student_list, pd.concat(frames, ignore_index=True))
+
+def lab_matrix_from_frame(student_list:list[Student], frame:pd.DataFrame) -> Lab_matrix:
+    """Returns the performance of every student for all the labs from the submissions of the lab contests"""
+    problem_scores:pd.DataFrame = lab_problem_scores(frame, LAB_IDS, UPSOLVE_RATIO).reset_index(name="score")
+    roster:pd.DataFrame = pd.DataFrame({
+        "handle": [student.handle.lower() if student.handle else None for student in student_list],
+        "student": range(len(student_list)),
+    })
+    problem_scores = problem_scores[problem_scores["problem"].isin(LAB_PROBLEMS)].merge(roster, on="handle")
+    lab_matrix:Lab_matrix = Lab_matrix([student.roll for student in student_list])
+    lab_matrix.set_scores(
+        problem_scores["student"].to_numpy(),
+        problem_scores["lab"].map(LAB_INDEX).to_numpy(),
+        problem_scores["problem"].map(PROBLEM_INDEX).to_numpy(),
+        problem_scores["score"].to_numpy()
+    )
+    lab_matrix.get_score()
+    lab_matrix.get_final_score()
+    return lab_matrix
+
+def update_info(student:Student, lab_performance:Lab_performance, cnt_solved:np.ndarray, cnt_upsolved:np.ndarray) -> None:
+    """Updates the lab info for a student in the sheet, given the problems solved and upsolved in every lab"""
+    sheet_connector.update_cell(SHEET_ROW_OFFSET + student.srl_no, 1, student.name)
+    sheet_connector.update_cell(SHEET_ROW_OFFSET + student.srl_no, 2, student.cf_id)
+    sheet_connector.update_cell(SHEET_ROW_OFFSET + student.srl_no, 3, lab_performance.final_score)
+    for lab_idx, lab_num in enumerate(LAB_NUMS):
+        sheet_connector.update_cell(SHEET_ROW_OFFSET + student.srl_no, LAB_COL_OFFSETS[lab_num], int(cnt_solved[lab_idx]))
+        sheet_connector.update_cell(SHEET_ROW_OFFSET + student.srl_no, LAB_COL_OFFSETS[lab_num] + 1, int(cnt_upsolved[lab_idx]))
+        sheet_connector.update_cell(SHEET_ROW_OFFSET + student.srl_no, LAB_COL_OFFSETS[lab_num] + 2, lab_performance.tot_score[lab_num])
+
+def connect(mongo_client:pymongo.MongoClient=None)->None:
+    """Connect to MongoDB and the Google sheet, reusing mongo_client if it is given"""
     try:
         global client, db, students, labs
-        client = pymongo.MongoClient()
+        client = mongo_client or pymongo.MongoClient()
         db = client[DB_NAME]
+        ensure_indexes(db)
         students = db[STUDENT_COLLECTION]
         labs = db[LAB_COLLECTION]
-        load_codeforces_keys()
+        codeforces.load_keys()
     except Exception as e:
         logging.error(msg=f"Error while connecting to the database: {e}")
         raise e
     try:
         global sheet_connector
-        sheet_connector = GoogleSheetConnector("labs")
+        sheet_connector = GoogleSheetConnector("labs", buffered=True, flush_rows=SHEET_FLUSH_ROWS, diff=SHEET_DIFF_SYNC)
     except Exception as e:
         logging.error(msg=f"Error while connecting to Google Sheet: {e}")
         raise e
-    student_list:list[Student] = get_student_info()
-    labs.delete_many({})
-    for student in student_list:
-        time.sleep(3)
-        logging.info(msg=f"Updating lab info for {student}")
-        sheet_connector.update_cell(SHEET_ROW_OFFSET + student.srl_no, 1, student.name)
-        sheet_connector.update_cell(SHEET_ROW_OFFSET + student.srl_no, 2, student.cf_id)
-        time.sleep(1)
-        lab_performance:Lab_performance = get_Lab_performance(student.cf_id, student.roll)
-        logging.debug(msg=f"Lab performance for {student}: {lab_performance.to_dict()}")
-        sheet_connector.update_cell(SHEET_ROW_OFFSET + student.srl_no, 3, lab_performance.final_score)
-        time.sleep(1)
-        for lab_num in ['1', '2', '3']:
-            cnt_solved = sum([1 for problem in lab_performance.scores[lab_num].values() if problem == 1])
-            cnt_unsolved = sum([1 for problem in lab_performance.scores[lab_num].values() if problem == 0])
-            cnt_upsolved = 6 - cnt_solved - cnt_unsolved
-            sheet_connector.update_cell(SHEET_ROW_OFFSET + student.srl_no, LAB_COL_OFFSETS[lab_num], cnt_solved)
-            sheet_connector.update_cell(SHEET_ROW_OFFSET + student.srl_no, LAB_COL_OFFSETS[lab_num] + 1, cnt_upsolved)
-            sheet_connector.update_cell(SHEET_ROW_OFFSET + student.srl_no, LAB_COL_OFFSETS[lab_num] + 2, lab_performance.tot_score[lab_num])
-            time.sleep(3)
-        labs.insert_one(lab_performance.to_dict())
-        logging.info(msg=f"Updated lab info for {student}")
+
+def run(student_list:list[Student], from_archive:bool=False)->None:
+    """Update the lab score for all the students
+
+    Results go to a staging collection in batches, checkpointing the students done, and
+    replace the labs collection only once every student is in staging. A failed run is
+    resumed by the next one, which skips the students already done and in staging. Runs from
+    the archive always start from scratch, since the students done by a failed run were scored
+    from Codeforces"""
+    sheet_connector.load_grid()
+    checkpoint:RunCheckpoint = RunCheckpoint(db, "labs", fresh=from_archive)
+    staging = db[f"{LAB_COLLECTION}{STAGING_SUFFIX}"]
+    if not checkpoint.resumed:
+        staging.drop()
+    if staging.name not in db.list_collection_names():
+        db.create_collection(staging.name)
+    create_indexes(staging, LAB_COLLECTION)
+    # Students marked done whose rows never made it to staging are redone
+    done:set[str] = checkpoint.done & set(staging.distinct("student_roll"))
+    logging.info(msg=f"Fetching lab performance for {len(student_list)} students")
+    lab_matrix:Lab_matrix = get_Lab_matrix(student_list, from_archive)
+    cnt_solved, cnt_upsolved, cnt_unsolved = lab_matrix.get_counts()
+    for start in range(0, len(student_list), CHECKPOINT_BATCH_SIZE):
+        operations:list[UpdateOne] = []
+        rolls:list[str] = []
+        for idx in range(start, min(start + CHECKPOINT_BATCH_SIZE, len(student_list))):
+            student:Student = student_list[idx]
+            if student.roll in done:
+                continue
+            lab_performance:Lab_performance = lab_matrix[idx]
+            logging.info(msg=f"Updating lab info for {student}")
+            logging.debug(msg=f"Lab performance for {student}: {lab_performance.to_dict()}")
+            update_info(student, lab_performance, cnt_solved[idx], cnt_upsolved[idx])
+            operations.append(UpdateOne({"student_roll": student.roll}, {"$set": lab_performance.to_dict()}, upsert=True))
+            rolls.append(student.roll)
+            logging.info(msg=f"Updated lab info for {student}")
+        bulk_write_batched(staging, operations)
+        sheet_connector.flush()
+        checkpoint.mark_done(rolls)
+    swap_collection(db, staging.name, LAB_COLLECTION, "student_roll", [student.roll for student in student_list])
+    checkpoint.finish()
+    refresh_grades(db)
     logging.info(msg="Finished updating lab info for all students")
+
+def regrade(student_list:list[Student])->None:
+    """Recomputes the lab score of every student from the submission archive, without calling Codeforces"""
+    run(student_list, from_archive=True)
+
+def main()->None:
+    """Update the lab score for all the students"""
+    connect()
+    run(get_student_info(students))
     client.close()
+    write_metrics("labs")
 
 if __name__ == "__main__":
+    log.basicConfig(filename="update_labs.log", filemode="w", level=log.DEBUG)
     logging.info(msg="Starting update_labs.py")
     main()
     logging.info(msg="Finished update_labs.py")
@@ -1,11 +1,15 @@
-from classes import Student, GoogleSheetConnector, DB_NAME, STUDENT_COLLECTION, PROBLEM_COLLECTION, PROBLEM_CAP
+from classes import write_metrics, submission_archive, ensure_indexes, bulk_write_batched, RunCheckpoint, CHECKPOINT_BATCH_SIZE, PIPELINE_QUEUE_SIZE, CF_MAX_WORKERS, get_student_info, Student, GoogleSheetConnector, SHEET_FLUSH_ROWS, SHEET_DIFF_SYNC, DB_NAME, STUDENT_COLLECTION, PROBLEM_COLLECTION, PROBLEM_CAP
+from grades import refresh_grades
+from codeforces import codeforces, CodeforcesError
+from scoring import submissions_frame, practice_counts
+from pipeline import Pipeline
 from collections import defaultdict
-import requests
+from typing import Optional
+import pandas as pd
 import pymongo
+from pymongo import UpdateOne
 import logging as log
-import time
 
-log.basicConfig(filename="update_practice.log", filemode="w", level=log.DEBUG)
 logging = log.getLogger(__name__)
 
 client = None
@@ -18,111 +22,150 @@ SHEET_ROW_OFFSET:int = 2
 SHEET_COL_OFFSET:int = 3
 
 START_TIME_STAMP = 1685298600 # Time stamp for May 29 2023 00:00:00
+PAGE_SIZE:int = 500 # Submissions requested per user.status call
 
 class Practice:
-    """Class to store practice info for a student"""
+    """Class to store practice info for a student
 
-    def __init__(self, roll:int, prac_info:dict[int:int]) -> None:
+    archived is set once every submission counted in prac_info is in the submission archive"""
+
+    __slots__ = ("roll", "prac_info", "cf_id", "last_id", "since", "archived")
+
+    def __init__(self, roll:int, prac_info:dict[int:int], cf_id:str=None, last_id:int=0, since:int=START_TIME_STAMP, archived:bool=False) -> None:
         self.roll = roll
         self.prac_info = prac_info
+        self.cf_id = cf_id
+        self.last_id = last_id
+        self.since = since
+        self.archived = archived
 
     def __str__(self) -> str:
         return f"Practice info for {self.roll}"
     
     def __repr__(self) -> str:
-        return f"Practice(roll={self.roll}, prac_info={self.prac_info})"
+        return f"Practice(roll={self.roll}, prac_info={self.prac_info}, cf_id={self.cf_id}, last_id={self.last_id})"
+
+    def solved(self, problem_score:int, count:int=1) -> None:
+        self.prac_info[problem_score] += count
+
+    def get_score(self) -> int:
+        return min(sum(key * val for key, val in self.prac_info.items()), PROBLEM_CAP)
     
     def to_dict(self) -> dict:
         dict_val:dict = {}
         dict_val["roll"] = self.roll
+        dict_val["cf_id"] = self.cf_id
+        dict_val["last_id"] = self.last_id
+        dict_val["since"] = self.since
+        dict_val["archived"] = self.archived
+        dict_val["score"] = self.get_score()
         for key, val in self.prac_info.items():
             dict_val[str(key)] = val
         return dict_val
 
-def get_problem_score(prob_rating:int) -> int:
-    """Returns the score for a problem based on its rating"""
-    return max(0, (prob_rating - 1099 + 199)//200)
-
-def get_student_info() -> list[Student]:
-    """Returns the list of students"""
-    student_list:list[Student] = []
-    cursor = students.find({})
-    for doc in cursor:
-        student_list.append(Student(
-            name=doc["name"],
-            roll=doc["roll"],
-            email=doc["email"],
-            srl_no=doc["sno"],
-            cf_id=doc["cf_id"]
-        ))
-    logging.info(msg=f"Student list created with {len(student_list)} students")
-    logging.debug(msg=f"Student list: {student_list}")
-    return student_list
-
-def get_practice_info(cf_id:str) -> dict[int, int]:
-    """Returns the practice info for a student"""
-    try:
-        data = requests.get(f"https://codeforces.com/api/user.status?handle={cf_id}&from=1").json()
-        if data["status"] == "FAILED":
-            logging.error(msg=f"Error while fetching practice info for {cf_id}: {data['comment']}")
-            return defaultdict(int)
-        if data["status"] != "OK":
-            logging.error(msg=f"Error while fetching practice info for {cf_id}: {data['data']}")
-            raise Exception(f"Error while fetching practice info for {cf_id}")
-    except Exception as e:
-        logging.error(msg=f"Error while fetching practice info for {cf_id}: {e}")
-        raise
-    practice_info:dict[int, int] = defaultdict(int)
-    for submission in data["result"]:
-        if submission["creationTimeSeconds"] < START_TIME_STAMP:
-            continue
-        if submission["verdict"] != "OK":
-            continue
+    @staticmethod
+    def from_dict(dict_val:dict) -> "Practice":
+        prac_info:dict[int, int] = defaultdict(int)
+        for key, val in dict_val.items():
+            if key.isdigit():
+                prac_info[int(key)] = val
+        return Practice(
+            roll=dict_val["roll"],
+            prac_info=prac_info,
+            cf_id=dict_val.get("cf_id"),
+            last_id=dict_val.get("last_id", 0),
+            since=dict_val.get("since", START_TIME_STAMP),
+            archived=dict_val.get("archived", False)
+        )
+
+def get_saved_practice() -> dict[int, Practice]:
+    """Returns the practice info stored by the previous runs, keyed by roll"""
+    saved:dict[int, Practice] = {}
+    for doc in practice_collection.find({}):
+        saved[doc["roll"]] = Practice.from_dict(doc)
+    logging.info(msg=f"Loaded saved practice info for {len(saved)} students")
+    return saved
+
+def get_new_submissions(cf_id:str, last_id:int) -> Optional[list[dict]]:
+    """Returns the submissions of a student newer than last_id and START_TIME_STAMP, or None if the handle is invalid"""
+    submissions:list[dict] = []
+    seen:set[int] = set()
+    start:int = 1
+    while True:
+        page_size:int = 0
         try:
-            prob_rating:int = int(submission["problem"]["rating"])
-        except KeyError:
-            continue
+            for submission in codeforces.iter_user_status(cf_id, start, PAGE_SIZE):
+                page_size += 1
+                if submission["id"] <= last_id or submission["creationTimeSeconds"] < START_TIME_STAMP:
+                    return submissions
+                if submission["id"] not in seen:
+                    seen.add(submission["id"])
+                    submissions.append(submission)
+        except CodeforcesError as e:
+            logging.error(msg=f"Error while fetching practice info for {cf_id}: {e}")
+            return None
         except Exception as e:
             logging.error(msg=f"Error while fetching practice info for {cf_id}: {e}")
             raise
-        practice_info[get_problem_score(prob_rating)] += 1
-    logging.debug(msg=f"Practice info for {cf_id}: {practice_info}")
-    return practice_info
+        if page_size < PAGE_SIZE:
+            return submissions
+        start += PAGE_SIZE
 
+def fetch_practice_info(student:Student, stud_prac:Optional[Practice]) -> tuple[Practice, Optional[list[dict]]]:
+    """Returns the saved practice info for a student along with the submissions made since the last run
 
-def update_info(stud_prac:Practice):
-    """Updates the practice info for a student"""
-    logging.info(msg=f"Updating practice info for {stud_prac.roll}")
-    try:
-        practice_collection.update_one(
-            {"roll": stud_prac.roll},
-            {"$set": stud_prac.to_dict()},
-            upsert=True
-        )
-    except Exception as e:
-        logging.error(msg=f"Error while updating practice info for {stud_prac.roll}: {e}")
-        raise
+    Students whose counts are not all archived yet get their whole history since START_TIME_STAMP
+    fetched again and are recounted from scratch, keeping the saved counts if the fetch fails"""
+    if stud_prac is None or str(stud_prac.cf_id).lower() != str(student.cf_id).lower() or stud_prac.since != START_TIME_STAMP:
+        stud_prac = Practice(roll=student.roll, prac_info=defaultdict(int), cf_id=student.cf_id)
+    if not student.handle:
+        return stud_prac, None
+    if stud_prac.archived:
+        return stud_prac, get_new_submissions(student.cf_id, stud_prac.last_id)
+    submissions:Optional[list[dict]] = get_new_submissions(student.cf_id, 0)
+    if submissions is None:
+        return stud_prac, None
+    # Buckets the recount leaves empty are written as 0 instead of keeping their old counts
+    prac_info:dict[int, int] = defaultdict(int, {key: 0 for key in stud_prac.prac_info})
+    return Practice(roll=student.roll, prac_info=prac_info, cf_id=student.cf_id), submissions
+
+def score_practice_info(student:Student, stud_prac:Practice, submissions:Optional[list[dict]]) -> Practice:
+    """Adds the problems solved in the new submissions to the practice info of a student"""
+    if submissions is None:
+        return stud_prac
+    # Submissions still being judged are left for the next run, along with everything newer than them
+    pending:list[int] = [submission["id"] for submission in submissions if submission.get("verdict") in (None, "TESTING")]
+    last_id:int = min(pending) - 1 if pending else max([submission["id"] for submission in submissions], default=stud_prac.last_id)
+    frame = submissions_frame([submission for submission in submissions if submission["id"] <= last_id], {student.cf_id})
+    if stud_prac.archived:
+        submission_archive.append(PROBLEM_COLLECTION, student.cf_id, frame)
+    else:
+        # The whole history was fetched, so it replaces whatever was archived for the handle
+        submission_archive.put(PROBLEM_COLLECTION, student.cf_id, frame, [student.cf_id])
+    for problem_score, count in practice_counts(frame).sum().items():
+        stud_prac.solved(int(problem_score), int(count))
+    stud_prac.last_id = last_id
+    stud_prac.archived = True
+    logging.debug(msg=f"Practice info for {student.cf_id}: {stud_prac.prac_info} ({len(submissions)} new submissions)")
+    return stud_prac
 
-    stud_roll = stud_prac.roll
-    stud_info = students.find_one({"roll": stud_roll})
-    if stud_info is None:
-        logging.error(msg=f"Student {stud_roll} not found in database")
-        return
-    sheet_connector.update_cell(SHEET_ROW_OFFSET + stud_info["sno"], 1, stud_info["name"])
-    sheet_connector.update_cell(SHEET_ROW_OFFSET + stud_info["sno"], 2, stud_info["cf_id"])
-    score:int = 0
+
+def update_info(student:Student, stud_prac:Practice) -> None:
+    """Updates the practice info for a student in the sheet"""
+    logging.info(msg=f"Updating practice info for {stud_prac.roll}")
+    sheet_connector.update_cell(SHEET_ROW_OFFSET + student.srl_no, 1, student.name)
+    sheet_connector.update_cell(SHEET_ROW_OFFSET + student.srl_no, 2, student.cf_id)
     for key, val in stud_prac.prac_info.items():
-        time.sleep(1)
-        sheet_connector.update_cell(SHEET_ROW_OFFSET + stud_info["sno"], SHEET_COL_OFFSET + key + 1, val)
-        score += val * key
-    sheet_connector.update_cell(SHEET_ROW_OFFSET + stud_info["sno"], 3, min(score, PROBLEM_CAP))
+        sheet_connector.update_cell(SHEET_ROW_OFFSET + student.srl_no, SHEET_COL_OFFSET + key + 1, val)
+    sheet_connector.update_cell(SHEET_ROW_OFFSET + student.srl_no, 3, stud_prac.get_score())
 
-def main():
-    """Update the practice info for all students"""
+def connect(mongo_client:pymongo.MongoClient=None)->None:
+    """Connect to MongoDB and the Google sheet, reusing mongo_client if it is given"""
     try:
         global client, db, students, practice_collection
-        client = pymongo.MongoClient()
+        client = mongo_client or pymongo.MongoClient()
         db = client[DB_NAME]
+        ensure_indexes(db)
         students = db[STUDENT_COLLECTION]
         practice_collection = db[PROBLEM_COLLECTION]
     except Exception as e:
@@ -130,19 +173,90 @@ def main():
         raise
     try:
         global sheet_connector
-        sheet_connector = GoogleSheetConnector("practice")
+        sheet_connector = GoogleSheetConnector("practice", buffered=True, flush_rows=SHEET_FLUSH_ROWS, diff=SHEET_DIFF_SYNC)
     except Exception as e:
         logging.error(msg=f"Error while connecting to Google Sheet: {e}")
         raise
-    student_list:list[Student] = get_student_info()
+
+def run(student_list:list[Student])->None:
+    """Update the practice info for all students
+
+    Students are processed in batches, each saved to MongoDB and the sheet and then
+    checkpointed. A failed run is resumed by the next one, which skips the students already done"""
+    sheet_connector.load_grid()
+    checkpoint:RunCheckpoint = RunCheckpoint(db, "practice")
+    saved:dict[int, Practice] = get_saved_practice()
+    pending:list[Student] = [student for student in student_list if student.roll not in checkpoint.done]
+    logging.info(msg=f"Fetching practice info for {len(pending)} students")
+
+    def write_batch(batch:list[tuple[Student, Practice]]) -> None:
+        operations:list[UpdateOne] = []
+        for student, stud_prac in batch:
+            update_info(student, stud_prac)
+            operations.append(UpdateOne({"roll": stud_prac.roll}, {"$set": stud_prac.to_dict()}, upsert=True))
+        try:
+            bulk_write_batched(practice_collection, operations)
+        except Exception as e:
+            logging.error(msg=f"Error while updating practice info: {e}")
+            raise
+        sheet_connector.flush()
+        checkpoint.mark_done([student.roll for student, _ in batch])
+
+    Pipeline(
+        fetch=lambda student: fetch_practice_info(student, saved.get(student.roll)),
+        score=lambda student, fetched: score_practice_info(student, *fetched),
+        write=write_batch,
+        fetch_workers=CF_MAX_WORKERS,
+        batch_size=CHECKPOINT_BATCH_SIZE,
+        queue_size=PIPELINE_QUEUE_SIZE
+    ).run(pending)
+    checkpoint.finish()
+    refresh_grades(db)
+
+def regrade(student_list:list[Student])->None:
+    """Recomputes the practice info of every student from the submission archive, without calling Codeforces
+
+    Only students whose counts are all archived are regraded, the others keep their saved
+    counts until the next run fetches and archives their whole history. The next run picks
+    up from the last submission the earlier runs saw"""
+    sheet_connector.load_grid()
+    saved:dict[int, Practice] = get_saved_practice()
+    operations:list[UpdateOne] = []
+    skipped:int = 0
     for student in student_list:
-        time.sleep(5)
-        logging.info(msg=f"Updating practice info for {student}")
-        practice_info:dict[int, int] = get_practice_info(student.cf_id)
-        stud_prac = Practice(roll=student.roll, prac_info=practice_info)
-        update_info(stud_prac)
+        if student.roll not in saved or not student.handle:
+            continue
+        stud_saved:Practice = saved[student.roll]
+        if not stud_saved.archived or stud_saved.since != START_TIME_STAMP or str(stud_saved.cf_id).lower() != student.cf_id.lower():
+            skipped += 1
+            continue
+        frame:Optional[pd.DataFrame] = submission_archive.read(PROBLEM_COLLECTION, student.cf_id)
+        if frame is None:
+            skipped += 1
+            continue
+        frame = frame[frame["creation_time"] >= START_TIME_STAMP]
+        # Buckets left empty under the new rules are written as 0 instead of keeping their old counts
+        prac_info:dict[int, int] = defaultdict(int, {key: 0 for key in stud_saved.prac_info})
+        stud_prac:Practice = Practice(roll=student.roll, prac_info=prac_info, cf_id=student.cf_id, last_id=stud_saved.last_id, archived=True)
+        for problem_score, count in practice_counts(frame).sum().items():
+            stud_prac.solved(int(problem_score), int(count))
+        update_info(student, stud_prac)
+        operations.append(UpdateOne({"roll": stud_prac.roll}, {"$set": stud_prac.to_dict()}, upsert=True))
+    bulk_write_batched(practice_collection, operations)
+    sheet_connector.flush()
+    if skipped:
+        logging.warning(msg=f"Kept the saved practice info of {skipped} students whose submissions are not all archived")
+    logging.info(msg=f"Regraded practice info for {len(operations)} students")
+    refresh_grades(db)
+
+def main():
+    """Update the practice info for all students"""
+    connect()
+    run(get_student_info(students))
+    write_metrics("practice")
 
 if __name__ == "__main__":
+    log.basicConfig(filename="update_practice.log", filemode="w", level=log.DEBUG)
     logging.info(msg="Starting update_practice.py")
     main()
     logging.info(msg="Ending update_practice.py")
\ No newline at end of file
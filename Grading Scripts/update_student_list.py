@@ -1,13 +1,15 @@
-from classes import Student, DB_NAME, STUDENT_COLLECTION
+from classes import write_metrics, import_cache, ensure_indexes, bulk_write_batched, Student, DB_NAME, STUDENT_COLLECTION
+from codeforces import codeforces
+from typing import Optional
 import pandas as pd
 import pymongo
+from pymongo import UpdateOne
 import logging as log
 
 STUDENT_FILE_NAME = "CP1 & CP2 Registration list.xlsx"
 STUDENT_ID_FILE = "CF_IDs.xlsx"
 STUDENT_SHEET = "CP1"
 
-log.basicConfig(filename="update_student_list.log", filemode="a", level=log.DEBUG)
 logging = log.getLogger(__name__)
 
 def read_sheet_students() -> pd.DataFrame:
@@ -36,52 +38,75 @@ def read_sheet_ids() -> pd.DataFrame:
         raise
     return df
 
+def read_roster() -> pd.DataFrame:
+    """Joins the student sheet with the CF ID sheet on roll, keeping the order of the student sheet"""
+    students:pd.DataFrame = read_sheet_students().iloc[:, :3]
+    students.columns = ["roll", "name", "email"]
+    cf_ids:pd.DataFrame = read_sheet_ids().iloc[:, 3:5]
+    cf_ids.columns = ["roll", "cf_id"]
+    # A student who registered their handle more than once keeps the last one
+    cf_ids = cf_ids.dropna(subset=["roll"]).drop_duplicates(subset="roll", keep="last")
+    roster:pd.DataFrame = students.merge(cf_ids, on="roll", how="left", sort=False)
+    roster["srl_no"] = range(1, len(roster) + 1)
+    for column in ("name", "email", "cf_id"):
+        roster[column] = roster[column].astype("string")
+    return roster
+
 def get_student_list() -> list[Student]:
-    """Returns the list of students"""
-    student_list:list[Student] = []
-    students:pd.DataFrame = read_sheet_students()
-    cf_ids:pd.DataFrame = read_sheet_ids()
-    ids:dict[str, str] = {}
-    for row in cf_ids.itertuples():
-        ids[row[4]] = row[5]
-    cnt:int = 0
-    for row in students.itertuples():
-        cnt += 1
-        student_list.append(Student(
-            name=row[2],
-            roll=row[1],
-            email=row[3],
-            srl_no=cnt,
-            cf_id=ids.get(row[1], None)
-        ))
+    """Returns the list of students, reparsing the excel files only if one of them changed since the last import"""
+    roster:pd.DataFrame = import_cache.get_frame("roster", [STUDENT_FILE_NAME, STUDENT_ID_FILE], read_roster)
+    roster = roster.astype(object).where(roster.notna(), None)
+    student_list:list[Student] = [
+        Student(name=record["name"], roll=record["roll"], email=record["email"], srl_no=record["srl_no"], cf_id=record["cf_id"])
+        for record in roster.to_dict("records")
+    ]
     logging.info(msg=f"Student list created with {len(student_list)} students")
     logging.debug(msg=f"Student list: {student_list}")
     return student_list
 
+def validate_handles(student_list:list[Student]) -> None:
+    """Replaces every handle with its canonical form and flags the handles that do not exist on Codeforces"""
+    resolved:dict[str, Optional[str]] = codeforces.resolve_handles(student.cf_id for student in student_list)
+    for student in student_list:
+        if not student.cf_id:
+            student.cf_valid = False
+            continue
+        key:str = str(student.cf_id).strip().lower()
+        if key not in resolved:
+            continue
+        if resolved[key] is None:
+            logging.warning(msg=f"Invalid Codeforces handle {student.cf_id} for {student}")
+            student.cf_valid = False
+        else:
+            student.cf_id = resolved[key]
+    logging.info(msg=f"{sum(not student.cf_valid for student in student_list)} students have no valid Codeforces handle")
+
 def update_students():
     """Updates the students to MongoDB"""
     logging.info("Fetching student list from Excel file")
     student_list:list[Student] = get_student_list()
+    logging.info("Validating Codeforces handles")
+    validate_handles(student_list)
     logging.info("Connecting to MongoDB")
     try:
         client = pymongo.MongoClient()
         db = client[DB_NAME]
+        ensure_indexes(db)
         collection = db[STUDENT_COLLECTION]
     except Exception as e:
         logging.error(msg=f"Error while connecting to MongoDB: {e}")
         raise
-    cnt:int = 0
     logging.info("Updating students to MongoDB")
-    for student in student_list:
-        cnt += 1
-        collection.update_one(
-            filter={"roll": student.roll},
-            update={"$set": student.to_dict()},
-            upsert=True
-        )
-    logging.info(f"{cnt} students updated to MongoDB")
+    operations:list[UpdateOne] = [
+        UpdateOne(filter={"roll": student.roll}, update={"$set": student.to_dict()}, upsert=True)
+        for student in student_list
+    ]
+    bulk_write_batched(collection, operations)
+    logging.info(f"{len(operations)} students updated to MongoDB")
+    write_metrics("student_list")
 
 if __name__ == "__main__":
+    log.basicConfig(filename="update_student_list.log", filemode="a", level=log.DEBUG)
     logging.info("Starting update_student_list.py")
     update_students()
     logging.info("Finished update_student_list.py")
\ No newline at end of file